@@ -0,0 +1,140 @@
+"""
+asyncio counterparts of the blocking CBModel operations (Python 3.5+).
+
+Each event loop gets its own connected ``acouchbase`` bucket per
+``CB_BUCKETS`` alias, so coroutines never block the loop on I/O and
+independent loads can run concurrently:
+
+    book, author = await asyncio.gather(Book.aget('bk::1'), Author.aget('atr::1'))
+    await book.asave()
+
+"""
+import asyncio
+import os
+import weakref
+
+from couchbase.exceptions import KeyExistsError, NotFoundError
+from six import string_types
+
+from django_couchbase import identity
+from django_couchbase.connection import connections
+
+_buckets = weakref.WeakKeyDictionary()
+_pid = os.getpid()
+
+
+async def _connect(alias):
+    from acouchbase.bucket import Bucket
+    bucket = Bucket(connections.connection_string(alias))
+    await bucket.connect()
+    return bucket
+
+
+async def get_async_bucket(alias):
+    """
+    Returns the connected async bucket for ``alias`` on the running loop.
+    """
+    global _pid
+    if _pid != os.getpid():
+        _buckets.clear()
+        _pid = os.getpid()
+    loop = asyncio.get_event_loop()
+    pending = _buckets.setdefault(loop, {})
+    future = pending.get(alias)
+    if future is None:
+        future = pending[alias] = asyncio.ensure_future(_connect(alias))
+    try:
+        return await future
+    except Exception:
+        pending.pop(alias, None)
+        raise
+
+
+class AsyncModelMixin(object):
+
+    async def aload(self, id):
+        identity_map = identity.current()
+        cached = identity_map.get(type(self), id) if identity_map is not None else None
+        if cached is not None and cached._loaded_state is not None:
+            self._hydrate(cached.id, cached._loaded_state, cached.rev)
+            return
+        bucket = await get_async_bucket(self.bucket)
+        try:
+            doc = await bucket.get(id)
+            self.from_row(doc)
+        except Exception:
+            raise NotFoundError
+        if identity_map is not None:
+            identity_map.add(self)
+
+    @classmethod
+    async def aget(cls, id):
+        objs = await cls.aget_many([id], missing='raise')
+        return objs[0]
+
+    @classmethod
+    async def aget_many(cls, ids, missing='skip'):
+        """
+        Async get_many: the gets are issued together on one connection.
+        """
+        ids, hydrated, fetch_ids = cls._lookup_many(ids, missing)
+        rows = {}
+        if fetch_ids:
+            bucket = await get_async_bucket(cls.bucket)
+            results = await asyncio.gather(*[bucket.get(id) for id in fetch_ids], return_exceptions=True)
+            for id, result in zip(fetch_ids, results):
+                if isinstance(result, NotFoundError):
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                rows[id] = result
+        return cls._hydrate_many(ids, hydrated, rows, missing)
+
+    async def asave(self):
+        from django_couchbase.models import _reference_batch
+        references = []
+        outer = getattr(_reference_batch, 'pending', None)
+        _reference_batch.pending = references
+        try:
+            is_new, data_dict = self._prepare_document()
+        finally:
+            _reference_batch.pending = outer
+        if references:
+            await asyncio.gather(*[obj.asave() for obj in references])
+        if data_dict is None:
+            return
+        bucket = await get_async_bucket(self.bucket)
+        try:
+            if is_new:
+                rv = await bucket.add(self.get_id(), data_dict)
+            else:
+                rv = await bucket.set(self.get_id(), data_dict, cas=self.rev or 0)
+        except KeyExistsError:
+            self._conflict()
+        self._saved(data_dict, rv.cas, is_new)
+
+    async def adelete(self):
+        from django.http import HttpResponseNotFound
+        bucket = await get_async_bucket(self.bucket)
+        try:
+            await bucket.remove(self.id)
+        except NotFoundError:
+            return HttpResponseNotFound
+        identity_map = identity.current()
+        if identity_map is not None:
+            identity_map.discard(self)
+
+    async def aload_related(self, related_attr, related_klass):
+        id = getattr(self, related_attr)
+        if isinstance(id, related_klass):
+            return id
+        if not id:
+            return related_klass()
+        return await related_klass.aget(id)
+
+    async def aload_related_list(self, related_attr, related_klass):
+        refs = getattr(self, related_attr) or []
+        if all(isinstance(ref, related_klass) for ref in refs):
+            return list(refs)
+        ids = [ref if isinstance(ref, string_types) else ref.get_id() for ref in refs]
+        return await related_klass.aget_many(ids, missing='raise')
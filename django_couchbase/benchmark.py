@@ -0,0 +1,200 @@
+"""
+Reproducible benchmarks of CBModel serialization, single and bulk
+loads/saves and CouchbaseCache hits/misses, run against the in-memory
+buckets of ``django_couchbase.fake`` (see the ``cb_benchmark`` command).
+
+Every scenario reports the median time per operation over ``repeat`` runs
+of ``number`` operations, so results can be saved as a baseline and
+compared with later runs on the same machine.
+"""
+import json
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models
+from django.test.utils import override_settings
+from django.utils import timezone
+from djangotoolbox.fields import EmbeddedModelField, ListField
+
+from django_couchbase import fake
+from django_couchbase.connection import connections
+from django_couchbase.models import CBModel, CBNestedModel
+
+BENCH_ALIAS = '__benchmark__'
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+class BenchLine(CBNestedModel):
+    class Meta:
+        abstract = True
+
+    doc_type = 'bench_line'
+
+    sku = models.CharField(max_length=20)
+    qty = models.IntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class BenchOrder(CBModel):
+    class Meta:
+        abstract = True
+
+    doc_type = 'bench_order'
+    id_prefix = 'bo'
+
+    customer = models.CharField(max_length=45)
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    placed = models.DateTimeField(null=True)
+    lines = ListField(EmbeddedModelField(BenchLine))
+
+# set after the class is created, so get_models() (and cb_indexes) never
+# sees it
+BenchOrder.bucket = BENCH_ALIAS
+
+
+def make_order(lines=50):
+    order = BenchOrder(customer='Aswin', total=Decimal('1299.50'), placed=timezone.now())
+    order.lines = [BenchLine(sku='sku-%d' % i, qty=i % 5 + 1, price=Decimal('9.99'))
+                   for i in range(lines)]
+    return order
+
+
+def _to_dict(number):
+    order = make_order()
+    start = _now()
+    for _ in range(number):
+        order.to_dict()
+    return _now() - start
+
+
+def _from_dict(number):
+    doc = make_order().to_dict()
+    start = _now()
+    for _ in range(number):
+        BenchOrder().from_dict(doc)
+    return _now() - start
+
+
+def _save(number):
+    orders = [make_order() for _ in range(number)]
+    start = _now()
+    for order in orders:
+        order.save()
+    return _now() - start
+
+
+def _bulk_save(number):
+    orders = [make_order() for _ in range(number)]
+    start = _now()
+    BenchOrder.bulk_save(orders)
+    return _now() - start
+
+
+def _get(number):
+    orders = [make_order() for _ in range(number)]
+    BenchOrder.bulk_save(orders)
+    start = _now()
+    for order in orders:
+        BenchOrder.get(order.id)
+    return _now() - start
+
+
+def _get_many(number):
+    orders = [make_order() for _ in range(number)]
+    BenchOrder.bulk_save(orders)
+    ids = [order.id for order in orders]
+    start = _now()
+    BenchOrder.get_many(ids)
+    return _now() - start
+
+
+def _cache(options=None):
+    from django_couchbase.memcached import CouchbaseCache
+    return CouchbaseCache(['fake://%s-cache' % BENCH_ALIAS], {'OPTIONS': options or {}})
+
+
+def _cache_hit(number):
+    cache = _cache()
+    value = make_order().to_dict()
+    cache.set('order', value, timeout=300)
+    start = _now()
+    for _ in range(number):
+        cache.get('order')
+    return _now() - start
+
+
+def _cache_miss(number):
+    cache = _cache()
+    start = _now()
+    for _ in range(number):
+        cache.get('missing')
+    return _now() - start
+
+
+def _cache_get_many(number):
+    cache = _cache()
+    cache.set_many(dict(('k%d' % i, i) for i in range(number)), timeout=300)
+    keys = ['k%d' % i for i in range(number)]
+    start = _now()
+    cache.get_many(keys)
+    return _now() - start
+
+
+SCENARIOS = OrderedDict([
+    ('to_dict', _to_dict),
+    ('from_dict', _from_dict),
+    ('save', _save),
+    ('bulk_save', _bulk_save),
+    ('get', _get),
+    ('get_many', _get_many),
+    ('cache_hit', _cache_hit),
+    ('cache_miss', _cache_miss),
+    ('cache_get_many', _cache_get_many),
+])
+
+
+def run(names=None, number=200, repeat=5, latency=0.0):
+    """
+    Runs the scenarios and returns {name: median microseconds per operation}.
+    """
+    buckets = dict(getattr(settings, 'CB_BUCKETS', {}))
+    buckets[BENCH_ALIAS] = 'fake://%s?latency=%s' % (BENCH_ALIAS, latency)
+    results = OrderedDict()
+    with override_settings(CB_BUCKETS=buckets):
+        connections.reset()
+        try:
+            for name in names or SCENARIOS:
+                timings = []
+                for _ in range(repeat):
+                    fake.reset()
+                    timings.append(SCENARIOS[name](number) / number * 1e6)
+                results[name] = sorted(timings)[len(timings) // 2]
+        finally:
+            fake.reset()
+            connections.reset()
+    return results
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline):
+    """
+    Returns [(name, baseline us, current us, change ratio)] for the scenarios
+    present in both.
+    """
+    rows = []
+    for name, current in results.items():
+        if name in baseline:
+            rows.append((name, baseline[name], current, current / baseline[name] - 1))
+    return rows
@@ -0,0 +1,123 @@
+"""
+Serializers for CouchbaseCache values.
+
+A codec has an id, stored in the item flags of every value it writes, and
+``dumps``/``loads`` functions. Items are decoded with the codec they were
+written with, so the serializer can be changed while old items are still
+in the bucket.
+
+    'OPTIONS': {
+        'serializer': 'msgpack',    # or 'orjson', 'pickle5', 'pickle', 'json'
+                                    # or a dotted path to an object with dumps/loads
+    }
+
+"""
+import json
+import time
+from collections import OrderedDict
+
+from django.utils.module_loading import import_string
+from six.moves import cPickle as pickle
+
+# id used for serializers given as dotted path without a codec_id
+CUSTOM_CODEC_ID = 0xFF
+
+
+class Codec(object):
+
+    def __init__(self, codec_id, name, dumps, loads):
+        self.codec_id = codec_id
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _pickle(protocol):
+    def load():
+        if protocol > pickle.HIGHEST_PROTOCOL:
+            raise ImportError('pickle protocol %d is not available' % protocol)
+        return (lambda value: pickle.dumps(value, protocol)), pickle.loads
+    return load
+
+
+def _json():
+    return (lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8'),
+            lambda data: json.loads(data.decode('utf-8')))
+
+
+def _msgpack():
+    import msgpack
+    return (lambda value: msgpack.packb(value, use_bin_type=True),
+            lambda data: msgpack.unpackb(data, raw=False))
+
+
+def _orjson():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+CODECS = OrderedDict([
+    ('pickle', (1, _pickle(pickle.HIGHEST_PROTOCOL))),
+    ('pickle5', (2, _pickle(5))),
+    ('json', (3, _json)),
+    ('msgpack', (4, _msgpack)),
+    ('orjson', (5, _orjson)),
+])
+
+_loaded = {}
+
+
+def get_codec(name):
+    """
+    Returns the Codec for a codec name or a dotted path.
+    """
+    codec = _loaded.get(name)
+    if codec is not None:
+        return codec
+    if name in CODECS:
+        codec_id, load = CODECS[name]
+        dumps, loads = load()
+        codec = Codec(codec_id, name, dumps, loads)
+    else:
+        serializer = import_string(name)
+        codec = Codec(getattr(serializer, 'codec_id', CUSTOM_CODEC_ID), name,
+                      serializer.dumps, serializer.loads)
+    _loaded[name] = codec
+    return codec
+
+
+def get_codec_by_id(codec_id, custom=None):
+    if custom is not None and custom.codec_id == codec_id:
+        return custom
+    for name, (candidate, load) in CODECS.items():
+        if candidate == codec_id:
+            return get_codec(name)
+    raise ValueError('unknown codec id %d' % codec_id)
+
+
+def benchmark(payloads, names=None, number=1000):
+    """
+    Measures every importable codec on ``payloads`` (a dict of label ->
+    value). Returns a list of (codec, label, bytes, encode us, decode us).
+    """
+    rows = []
+    for name in names or CODECS:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            continue
+        for label, payload in payloads.items():
+            try:
+                data = codec.dumps(payload)
+            except (TypeError, ValueError):
+                continue
+            start = time.time()
+            for _ in range(number):
+                codec.dumps(payload)
+            encode = (time.time() - start) / number * 1e6
+            start = time.time()
+            for _ in range(number):
+                codec.loads(data)
+            decode = (time.time() - start) / number * 1e6
+            rows.append((name, label, len(data), encode, decode))
+    return rows
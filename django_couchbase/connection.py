@@ -0,0 +1,203 @@
+"""
+Shared Couchbase bucket connections.
+
+Every alias in ``settings.CB_BUCKETS`` gets a small pool of
+``couchbase.bucket.Bucket`` objects. Buckets are opened lazily on first use
+and handed out round-robin; they are opened with ``LOCKMODE_WAIT`` so one
+bucket can be shared by several threads. A bucket handed out again after
+``CB_BUCKET_HEALTH_CHECK_INTERVAL`` seconds is first probed with a quiet get
+(bounded by its operation timeout) and reopened if that fails.
+
+settings
+
+    CB_BUCKETS = {
+        "MAIN_BUCKET" : '127.0.0.1/default'
+    }
+    CB_BUCKET_POOL_SIZE = 1
+    CB_BUCKET_HEALTH_CHECK_INTERVAL = 30    # None disables the checks
+    CB_INSTRUMENTATION = False      # see django_couchbase.instrumentation
+
+A location starting with ``fake://`` (``'fake://default?latency=0.001'``)
+uses the in-memory buckets of ``django_couchbase.fake``.
+
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+
+from couchbase import connection
+from couchbase.bucket import Bucket
+from couchbase.exceptions import CouchbaseError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from django_couchbase import fake, instrumentation
+
+log = logging.getLogger('django.couchbase')
+
+DEFAULT_POOL_SIZE = 1
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+# read by the health check, normally missing
+HEALTH_CHECK_KEY = '__django_couchbase_health_check__'
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class BucketPool(object):
+    """
+    A fixed number of lazily opened buckets for one connection string.
+    """
+
+    def __init__(self, connection_string, size=DEFAULT_POOL_SIZE,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.connection_string = connection_string
+        self.size = max(int(size), 1)
+        self.health_check_interval = health_check_interval
+        self._buckets = [None] * self.size
+        self._checked = [0.0] * self.size
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if fake.is_fake(self.connection_string):
+            return fake.from_url(self.connection_string)
+        return Bucket(self.connection_string, lockmode=connection.LOCKMODE_WAIT)
+
+    def is_healthy(self, bucket):
+        """
+        One cheap round trip: a quiet get of a key that normally does not
+        exist, which only fails on connection errors and timeouts.
+        """
+        try:
+            bucket.get(HEALTH_CHECK_KEY, quiet=True)
+        except CouchbaseError as e:
+            log.warning('Couchbase: health check of %s failed: %s', self.connection_string, e)
+            return False
+        return True
+
+    def _check_due(self, idx):
+        interval = self.health_check_interval
+        return interval is not None and _now() - self._checked[idx] >= interval
+
+    def get(self):
+        idx = next(self._counter) % self.size
+        bucket = self._buckets[idx]
+        if bucket is not None and not self._check_due(idx):
+            return bucket
+
+        with self._lock:
+            bucket = self._buckets[idx]
+            if bucket is None:
+                bucket = self.connect()
+                self._buckets[idx] = bucket
+                self._checked[idx] = _now()
+                return bucket
+            if not self._check_due(idx):
+                return bucket
+            # claims the check, other threads keep using the bucket while
+            # it runs instead of waiting on the lock
+            self._checked[idx] = _now()
+
+        if self.is_healthy(bucket):
+            return bucket
+        log.warning('Couchbase: reconnecting unhealthy bucket %s', self.connection_string)
+        replacement = self.connect()
+        with self._lock:
+            if self._buckets[idx] is bucket:
+                self._buckets[idx] = replacement
+                self._checked[idx] = _now()
+        return replacement
+
+    def close(self):
+        with self._lock:
+            self._buckets = [None] * self.size
+            self._checked = [0.0] * self.size
+
+
+class BucketRegistry(object):
+    """
+    Process-wide map of ``CB_BUCKETS`` aliases to bucket pools.
+
+    The registry remembers the pid it was populated in. A forked worker
+    (gunicorn, uwsgi) sees a different pid and starts with empty pools instead
+    of sharing the parent's sockets.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def connection_string(self, alias):
+        location = getattr(settings, 'CB_BUCKETS', {}).get(alias)
+        if not location:
+            raise ImproperlyConfigured("bucket alias '%s' is not defined in CB_BUCKETS" % alias)
+        if fake.is_fake(location):
+            return location
+        return ''.join(['couchbase://', location])
+
+    def pool(self, alias):
+        if self._pid != os.getpid():
+            self.reset()
+        pool = self._pools.get(alias)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(alias)
+                if pool is None:
+                    pool = BucketPool(self.connection_string(alias),
+                                      getattr(settings, 'CB_BUCKET_POOL_SIZE', DEFAULT_POOL_SIZE),
+                                      getattr(settings, 'CB_BUCKET_HEALTH_CHECK_INTERVAL',
+                                              DEFAULT_HEALTH_CHECK_INTERVAL))
+                    self._pools[alias] = pool
+        return pool
+
+    def __getitem__(self, alias):
+        return self._wrap(alias, self.pool(alias).get())
+
+    def open(self, alias):
+        """
+        A new bucket for ``alias``, outside the pool, for a thread that
+        should not share its connection (bulk writers).
+        """
+        return self._wrap(alias, self.pool(alias).connect())
+
+    def _wrap(self, alias, bucket):
+        if instrumentation.enabled():
+            return instrumentation.InstrumentedBucket(bucket, bucket_name(alias))
+        return bucket
+
+    def reset(self):
+        with self._lock:
+            self._pools = {}
+            self._pid = os.getpid()
+
+
+connections = BucketRegistry()
+
+
+def get_bucket(alias):
+    return connections[alias]
+
+
+def bucket_name(alias):
+    """
+    The bucket name of a CB_BUCKETS alias ('127.0.0.1/default' -> 'default').
+    """
+    location = connections.connection_string(alias)
+    return location.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+
+
+class BucketDescriptor(object):
+    """
+    Resolves ``Model.db`` (and ``instance.db``) to a shared bucket for the
+    model's ``bucket`` alias.
+    """
+
+    def __get__(self, instance, owner):
+        alias = getattr(owner, 'bucket', None)
+        if alias is None:
+            raise AttributeError("'%s' has no bucket" % owner.__name__)
+        return connections[alias]
@@ -0,0 +1,58 @@
+"""
+django-debug-toolbar panel listing the Couchbase operations of a request.
+
+    DEBUG_TOOLBAR_PANELS = [
+        # ...
+        'django_couchbase.debug_panel.CouchbasePanel',
+    ]
+
+The operations are collected from ``instrumentation.operation_finished``, so
+``CB_INSTRUMENTATION`` (or the cache 'instrument' option) must be on.
+"""
+from threading import local
+
+from debug_toolbar.panels import Panel
+from django.utils.html import format_html, format_html_join
+from django.utils.translation import ungettext
+
+from django_couchbase.instrumentation import operation_finished
+
+_recording = local()
+
+
+def _record(sender, op, bucket, keys, bytes, duration, outcome, **kwargs):
+    operations = getattr(_recording, 'operations', None)
+    if operations is not None:
+        operations.append((op, bucket, keys, bytes, duration * 1000, outcome))
+
+
+class CouchbasePanel(Panel):
+    title = 'Couchbase'
+
+    @property
+    def nav_subtitle(self):
+        operations = self.get_stats().get('operations', [])
+        return ungettext('%(count)d operation in %(ms).2fms', '%(count)d operations in %(ms).2fms',
+                         len(operations)) % {'count': len(operations),
+                                             'ms': sum(o[4] for o in operations)}
+
+    def enable_instrumentation(self):
+        _recording.operations = []
+        operation_finished.connect(_record, dispatch_uid='django_couchbase.debug_panel')
+
+    def disable_instrumentation(self):
+        operation_finished.disconnect(dispatch_uid='django_couchbase.debug_panel')
+
+    def generate_stats(self, request, response):
+        self.record_stats({'operations': getattr(_recording, 'operations', None) or []})
+        _recording.operations = None
+
+    @property
+    def content(self):
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>',
+            ((op, bucket, keys, size, '%.2f' % ms, outcome)
+             for op, bucket, keys, size, ms, outcome in self.get_stats().get('operations', [])))
+        return format_html(
+            '<table><thead><tr><th>Operation</th><th>Bucket</th><th>Keys</th><th>Bytes</th>'
+            '<th>ms</th><th>Outcome</th></tr></thead><tbody>{}</tbody></table>', rows)
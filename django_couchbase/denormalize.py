@@ -0,0 +1,124 @@
+"""
+Keeps the attributes copied by PartialReferenceField up to date.
+
+    class Book(CBModel):
+        ...
+        author = PartialReferenceField(Author, links={'author_name': 'name'})
+
+Saving a book stores the author id and ``author_name``. When an author is
+saved with a different ``name``, every book referencing it is updated with
+one N1QL UPDATE per dependent model, so pages listing books can show the
+author's name without loading the authors.
+
+The updates run on a background thread, after save() returns; set
+``CB_DENORMALIZE_SYNC = True`` to run them in save() instead (tests,
+scripts). Failures are logged, the copies then stay stale until the next
+change.
+"""
+import logging
+import os
+import threading
+
+from six.moves import queue
+
+from django.conf import settings
+
+from django_couchbase.connection import bucket_name
+from django_couchbase.query import doc_type_condition, field_path, n1ql_executor, quote
+
+log = logging.getLogger('django.couchbase')
+
+# referenced model -> [(dependent model, field name, links)]
+_dependents = {}
+
+_queue = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def register(model, field):
+    """
+    Records that ``model`` copies ``field.links`` from ``field.embedded_model``.
+    """
+    _dependents.setdefault(field.embedded_model, []).append((model, field.name, dict(field.links)))
+
+
+def dependents(model):
+    deps = []
+    for klass in model.__mro__:
+        deps.extend(_dependents.get(klass, ()))
+    return deps
+
+
+def propagate(obj, old_state, new_state):
+    """
+    Schedules the updates of the documents copying attributes of ``obj``
+    that differ between ``old_state`` and ``new_state``. Without an
+    ``old_state`` (an object saved over a document it did not load) every
+    attribute counts as changed.
+    """
+    for model, name, links in dependents(type(obj)):
+        changed = dict((link, new_state.get(attr)) for link, attr in links.items()
+                       if old_state is None or new_state.get(attr) != old_state.get(attr))
+        if changed:
+            _schedule(model, name, obj.id, changed)
+
+
+def update_statement(model, name, values):
+    """
+    Returns the UPDATE statement and parameters setting ``values`` (link ->
+    value) on the documents of ``model`` whose field ``name`` is the id
+    given as last parameter.
+    """
+    params = []
+    assignments = []
+    for link, value in sorted(values.items()):
+        params.append(value)
+        assignments.append('%s = $%d' % (field_path(link), len(params)))
+    statement = 'UPDATE %s AS d SET %s WHERE %s AND %s = $%d' % (
+        quote(bucket_name(model.bucket)), ', '.join(assignments),
+        doc_type_condition(model), field_path(name), len(params) + 1)
+    return statement, params
+
+
+def _run(model, name, id, values):
+    statement, params = update_statement(model, name, values)
+    try:
+        for _ in n1ql_executor(model)(statement, params + [id]):
+            pass
+    except Exception as e:
+        log.error('CouchbaseError: %s' % e, exc_info=True)
+
+
+def _schedule(model, name, id, values):
+    if getattr(settings, 'CB_DENORMALIZE_SYNC', False):
+        _run(model, name, id, values)
+    else:
+        _work_queue().put((model, name, id, values))
+
+
+def _work_queue():
+    global _queue, _worker_pid
+    if _worker_pid != os.getpid():
+        with _worker_lock:
+            if _worker_pid != os.getpid():
+                _queue = queue.Queue()
+                worker = threading.Thread(target=_work, args=(_queue,), name='cb-denormalize')
+                worker.daemon = True
+                worker.start()
+                _worker_pid = os.getpid()
+    return _queue
+
+
+def _work(jobs):
+    while True:
+        _run(*jobs.get())
+        jobs.task_done()
+
+
+def flush():
+    """
+    Waits until the scheduled updates are done.
+    """
+    if _queue is not None and _worker_pid == os.getpid():
+        _queue.join()
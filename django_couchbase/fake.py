@@ -0,0 +1,852 @@
+"""
+In-process stand-in for the parts of ``couchbase.bucket.Bucket`` used by
+CBModel and CouchbaseCache, for tests and benchmarks without a cluster.
+
+Select it with a ``fake://`` location, optionally with a simulated round-trip
+latency in seconds:
+
+    CB_BUCKETS = {
+        "MAIN_BUCKET": 'fake://default?latency=0.0005'
+    }
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_couchbase.memcached.CouchbaseCache',
+            'LOCATION': ['fake://cache'],
+        }
+    }
+
+Buckets with the same name share their documents within the process.
+Values are pickled on write like FMT_PICKLE, so callers never share objects
+with the store. CAS, expiry (relative seconds, or a unix time beyond 30
+days), counters, the ``*_multi`` variants with ``quiet`` (writes also take a
+couchbase.items.ItemOptionDict with a CAS per item) and the sub-document
+get, exists, upsert, insert, replace, remove, array and counter operations
+behave like the server's.
+
+``n1ql_query`` understands the statements this package writes (querysets,
+denormalize updates, export pages): SELECT and UPDATE on one bucket with
+USE KEYS, conjunctions of the queryset lookups, META().id comparisons,
+ORDER BY, LIMIT and OFFSET. Anything else raises NotImplementedError.
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from couchbase.exceptions import (CouchbaseError, KeyExistsError, NotFoundError,
+                                  SubdocPathExistsError, SubdocPathNotFoundError)
+import couchbase.subdocument as SD
+from six import string_types
+from six.moves import cPickle as pickle
+from six.moves.urllib.parse import parse_qs, urlparse
+
+SCHEME = 'fake://'
+
+# ttl values above this are absolute unix times, as in memcached
+RELATIVE_TTL_LIMIT = 30 * 24 * 3600
+
+_stores = {}
+_stores_lock = threading.Lock()
+_cas = itertools.count(1)
+
+
+def is_fake(location):
+    return location.startswith(SCHEME)
+
+
+def from_url(url):
+    """
+    Returns a FakeBucket for 'fake://[host/]name[?latency=seconds]'.
+    """
+    parsed = urlparse(url)
+    name = (parsed.path.strip('/') or parsed.netloc or 'default').rsplit('/', 1)[-1]
+    latency = float(parse_qs(parsed.query).get('latency', ['0'])[0])
+    return FakeBucket(name, latency=latency)
+
+
+def reset():
+    """
+    Drops the documents of every fake bucket.
+    """
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        with store.lock:
+            store.docs.clear()
+
+
+def _expiry(ttl):
+    if not ttl:
+        return None
+    if ttl > RELATIVE_TTL_LIMIT:
+        return float(ttl)
+    return time.time() + ttl
+
+
+class Result(object):
+
+    def __init__(self, key, value=None, cas=0, success=True, rc=0):
+        self.key = key
+        self.value = value
+        self.cas = cas
+        self.success = success
+        self.rc = rc
+
+
+class MultiResult(dict):
+
+    @property
+    def all_ok(self):
+        return all(result.success for result in self.values())
+
+
+# libcouchbase's LCB_SUBDOC_PATH_ENOENT
+_PATH_NOT_FOUND = 0x3F
+
+
+def _multi_docs(kv):
+    """
+    key -> (value, cas) from the argument of a ``*_multi`` write: a dict of
+    values, or a couchbase.items.ItemOptionDict whose items carry their CAS.
+    """
+    if isinstance(kv, dict):
+        return OrderedDict((key, (value, 0)) for key, value in kv.items())
+    return OrderedDict((item.key, (item.value, 0 if (options or {}).get('ignore_cas') else item.cas))
+                       for item, options in kv)
+
+
+class SubdocResult(object):
+
+    def __init__(self, key, cas, specs):
+        self.key = key
+        self.cas = cas
+        self.success = True
+        self._specs = specs
+
+    def _find(self, path_or_index):
+        if isinstance(path_or_index, int):
+            return self._specs[path_or_index]
+        for spec in self._specs:
+            if spec[0] == path_or_index:
+                return spec
+        raise KeyError(path_or_index)
+
+    def exists(self, path_or_index):
+        return self._find(path_or_index)[1]
+
+    def __getitem__(self, path_or_index):
+        path, found, value = self._find(path_or_index)
+        if not found:
+            raise SubdocPathNotFoundError({'message': 'path %s not found' % path, 'key': self.key})
+        return value
+
+    def get(self, path_or_index, default=None):
+        # like the SDK, (error code, value) rather than the value
+        path, found, value = self._find(path_or_index)
+        return (0, value) if found else (_PATH_NOT_FOUND, default)
+
+
+_PROBE = object()
+_spec_table = None
+
+
+def _spec_ops():
+    """
+    Maps the opcodes of couchbase.subdocument specs to (name, position of
+    the value in the spec or None, whether the value is a tuple of values),
+    learned from the SDK's own builders.
+    """
+    global _spec_table
+    if _spec_table is None:
+        table = {}
+        for name in ('get', 'exists', 'remove'):
+            table[getattr(SD, name)('p')[0]] = (name, None, False)
+        for name in ('upsert', 'insert', 'replace', 'array_append', 'array_prepend',
+                     'array_addunique', 'counter'):
+            spec = getattr(SD, name)('p', _PROBE)
+            for position, item in enumerate(spec):
+                if item is _PROBE or (isinstance(item, tuple) and _PROBE in item):
+                    table[spec[0]] = (name, position, item is not _PROBE)
+                    break
+        _spec_table = table
+    return _spec_table
+
+
+def _spec_value(spec, value_at, multi):
+    if value_at is None:
+        return None
+    return list(spec[value_at]) if multi else spec[value_at]
+
+
+def _split_path(path):
+    parts = []
+    for part in path.split('.'):
+        while '[' in part:
+            head, _, rest = part.partition('[')
+            if head:
+                parts.append(head)
+            index, _, part = rest.partition(']')
+            parts.append(int(index))
+        if part:
+            parts.append(part)
+    return parts
+
+
+def _resolve(doc, parts, create=False):
+    """
+    Returns the container holding the last part of the path.
+    """
+    for part in parts[:-1]:
+        try:
+            doc = doc[part]
+        except (KeyError, IndexError, TypeError):
+            if not create or isinstance(part, int):
+                raise SubdocPathNotFoundError({'message': 'path not found'})
+            doc[part] = {}
+            doc = doc[part]
+    return doc
+
+
+def _has(container, part):
+    if isinstance(part, int):
+        return isinstance(container, list) and -len(container) <= part < len(container)
+    return isinstance(container, dict) and part in container
+
+
+class _Store(object):
+
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        entry = self.docs.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            del self.docs[key]
+            return None
+        return entry
+
+
+def _store(name):
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None:
+            store = _stores[name] = _Store()
+        return store
+
+
+# N1QL
+
+_SELECT = re.compile(
+    r'^SELECT (?P<select>.+?) FROM `(?:[^`]|``)+` (?P<alias>\w+)(?: USE KEYS \$(?P<keys>\d+))?'
+    r'(?: WHERE (?P<where>.+?))?(?: ORDER BY (?P<order>.+?))?(?: LIMIT (?P<limit>\d+))?'
+    r'(?: OFFSET (?P<offset>\d+))?$', re.S)
+_UPDATE = re.compile(
+    r'^UPDATE `(?:[^`]|``)+` AS (?P<alias>\w+)(?: USE KEYS \$(?P<keys>\d+))? SET (?P<set>.+?)'
+    r'(?: WHERE (?P<where>.+?))?(?: RETURNING (?P<returning>.+))?$', re.S)
+_COMPARISON = re.compile(r'^(.+?) (=|!=|>=|<=|>|<|IN|LIKE) (.+)$', re.S)
+_ALIASED = re.compile(r'^(.+) AS `((?:[^`]|``)+)`$', re.S)
+_NAME = re.compile(r'`((?:[^`]|``)*)`')
+
+# the N1QL collation order of the JSON types
+_MISSING = object()
+_RANKS = ((bool, 2), (int, 3), (float, 3), (string_types, 4), (list, 5), (dict, 6))
+
+
+class _Unsupported(NotImplementedError):
+    pass
+
+
+def _closing(text, start):
+    """
+    Index of the bracket closing the one at ``start``, skipping strings and
+    quoted names.
+    """
+    depth = 0
+    quote = None
+    i = start
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\' and quote == '"':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"`':
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+            if not depth:
+                return i
+        i += 1
+    raise _Unsupported('unbalanced brackets in %s' % text)
+
+
+def _split(text, sep):
+    """
+    Splits ``text`` on ``sep`` outside brackets, strings and quoted names.
+    """
+    parts = []
+    start = i = 0
+    while i < len(text):
+        char = text[i]
+        if char in '([{':
+            i = _closing(text, i) + 1
+        elif char in '"`':
+            end = text.index(char, i + 1)
+            while char == '"' and text[end - 1] == '\\':
+                end = text.index(char, end + 1)
+            i = end + 1
+        elif text.startswith(sep, i):
+            parts.append(text[start:i])
+            i += len(sep)
+            start = i
+        else:
+            i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _wrapped(text, prefix):
+    """
+    The inside of ``prefix(...)`` if ``text`` is exactly that, else None.
+    """
+    if text.startswith(prefix + '(') and _closing(text, len(prefix)) == len(text) - 1:
+        return text[len(prefix) + 1:-1]
+    return None
+
+
+def _collation(value):
+    if value is _MISSING:
+        return (0, 0)
+    if value is None:
+        return (1, 0)
+    for types, rank in _RANKS:
+        if isinstance(value, types):
+            return (rank, json.dumps(value, sort_keys=True) if rank == 6 else value)
+    return (7, repr(value))
+
+
+def _like(pattern):
+    regex = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == '\\':
+            regex.append(re.escape(next(chars, '')))
+        elif char == '%':
+            regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    return re.compile('^%s$' % ''.join(regex), re.S)
+
+
+class _Statement(object):
+    """
+    Compiles the parts of a statement to functions of a row, the tuple
+    (id, cas, document).
+    """
+
+    def __init__(self, alias, params):
+        self.alias = alias
+        self.params = params
+
+    def path(self, text):
+        """
+        The names of ``alias.`a`.`b```, or None if ``text`` is no such path.
+        """
+        if text == self.alias:
+            return []
+        if not text.startswith(self.alias + '.`'):
+            return None
+        rest = text[len(self.alias):]
+        names = _NAME.findall(rest)
+        if ''.join('.`%s`' % name for name in names) != rest:
+            return None
+        return [name.replace('``', '`') for name in names]
+
+    def operand(self, text):
+        if text == 'META(%s).id' % self.alias:
+            return lambda row: row[0]
+        if text == 'META(%s).cas' % self.alias:
+            return lambda row: row[1]
+        if text.startswith('$') and text[1:].isdigit():
+            value = self.params[int(text[1:]) - 1]
+            return lambda row: value
+        inner = _wrapped(text, 'LOWER')
+        if inner is not None:
+            value = self.operand(inner)
+            return lambda row: _lower(value(row))
+        names = self.path(text)
+        if names is not None:
+            return lambda row: _lookup(row[2], names)
+        if text.startswith('{'):
+            return self.object(text)
+        try:
+            value = json.loads(text)
+        except ValueError:
+            raise _Unsupported('unsupported expression %s' % text)
+        return lambda row: value
+
+    def object(self, text):
+        if _closing(text, 0) != len(text) - 1:
+            raise _Unsupported('unsupported expression %s' % text)
+        fields = []
+        for item in _split(text[1:-1], ', '):
+            key, _, value = item.partition(': ')
+            fields.append((json.loads(key), self.operand(value)))
+
+        def build(row):
+            built = {}
+            for key, value in fields:
+                value = value(row)
+                if value is not _MISSING:
+                    built[key] = value
+            return built
+        return build
+
+    def condition(self, text):
+        if text == 'TRUE':
+            return lambda row: True
+        terms = _split(text, ' AND ')
+        if len(terms) > 1:
+            conditions = [self.condition(term) for term in terms]
+            return lambda row: all(condition(row) for condition in conditions)
+        inner = _wrapped(text, 'NOT ')
+        if inner is not None:
+            condition = self.condition(inner)
+            return lambda row: not condition(row)
+        inner = _wrapped(text, '')
+        if inner is not None:
+            return self.condition(inner)
+        inner = _wrapped(text, 'CONTAINS')
+        if inner is not None:
+            haystack, needle = [self.operand(part) for part in _split(inner, ', ')]
+            return lambda row: _contains(haystack(row), needle(row))
+        for suffix, valued in ((' IS NOT VALUED', False), (' IS VALUED', True)):
+            if text.endswith(suffix):
+                value = self.operand(text[:-len(suffix)])
+                return lambda row: (value(row) not in (None, _MISSING)) == valued
+        match = _COMPARISON.match(text)
+        if match is None:
+            raise _Unsupported('unsupported condition %s' % text)
+        left, operator, right = match.groups()
+        return _comparison(operator, self.operand(left), self.operand(right))
+
+    def projection(self, text):
+        """
+        Returns a function building the result row of a document.
+        """
+        columns = []
+        for item in _split(text, ', '):
+            if item == self.alias + '.*':
+                columns.append((None, lambda row: row[2]))
+                continue
+            match = _ALIASED.match(item)
+            if match is None:
+                raise _Unsupported('unsupported result expression %s' % item)
+            columns.append((match.group(2).replace('``', '`'), self.operand(match.group(1))))
+
+        def project(row):
+            result = {}
+            for name, value in columns:
+                value = value(row)
+                if name is None:
+                    result.update(value)
+                elif value is not _MISSING:
+                    result[name] = value
+            return result
+        return project
+
+    def assignments(self, text):
+        assignments = []
+        for item in _split(text, ', '):
+            target, _, value = item.partition(' = ')
+            names = self.path(target)
+            if not names:
+                raise _Unsupported('unsupported assignment %s' % item)
+            assignments.append((names, self.operand(value)))
+        return assignments
+
+    def order(self, text):
+        keys = []
+        for item in _split(text, ', '):
+            expression, _, direction = item.rpartition(' ')
+            if direction not in ('ASC', 'DESC'):
+                expression, direction = item, 'ASC'
+            keys.append((self.operand(expression), direction == 'DESC'))
+        return keys
+
+
+def _lookup(doc, names):
+    for name in names:
+        if not isinstance(doc, dict) or name not in doc:
+            return _MISSING
+        doc = doc[name]
+    return doc
+
+
+def _lower(value):
+    return value.lower() if isinstance(value, string_types) else value
+
+
+def _contains(haystack, needle):
+    return (isinstance(haystack, string_types) and isinstance(needle, string_types) and
+            needle in haystack)
+
+
+def _comparison(operator, left, right):
+    def compare(row):
+        a, b = left(row), right(row)
+        if a in (None, _MISSING) or b in (None, _MISSING):
+            return False
+        if operator == 'IN':
+            return isinstance(b, list) and a in b
+        if operator == 'LIKE':
+            return isinstance(a, string_types) and bool(_like(b).match(a))
+        if operator in ('=', '!='):
+            return (_collation(a) == _collation(b)) == (operator == '=')
+        a, b = _collation(a), _collation(b)
+        try:
+            return {'>': a > b, '>=': a >= b, '<': a < b, '<=': a <= b}[operator]
+        except TypeError:
+            return False
+    return compare
+
+
+def _assign(doc, names, value):
+    for name in names[:-1]:
+        if not isinstance(doc.get(name), dict):
+            doc[name] = {}
+        doc = doc[name]
+    doc[names[-1]] = value
+
+
+class FakeBucket(object):
+
+    def __init__(self, name='default', latency=0.0):
+        self.bucket = name
+        self.latency = latency
+        self.default_format = None
+        self._store = _store(name)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _not_found(self, key):
+        return NotFoundError({'message': 'document %s not found' % key, 'key': key})
+
+    def _exists(self, key):
+        return KeyExistsError({'message': 'document %s exists or CAS mismatch' % key, 'key': key})
+
+    # single documents
+
+    def _get(self, key, ttl=0, quiet=False):
+        with self._store.lock:
+            entry = self._store.live(key)
+            if entry is None:
+                if quiet:
+                    return Result(key, success=False, rc=NotFoundError.CODE)
+                raise self._not_found(key)
+            pickled, cas, expires = entry
+            if ttl:
+                self._store.docs[key] = (pickled, cas, _expiry(ttl))
+        return Result(key, pickle.loads(pickled), cas)
+
+    def _store_value(self, key, value, cas=0, ttl=0, mode='set'):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._store.lock:
+            entry = self._store.live(key)
+            if mode == 'add' and entry is not None:
+                raise self._exists(key)
+            if (mode == 'replace' or cas) and entry is None:
+                raise self._not_found(key)
+            if cas and entry[1] != cas:
+                raise self._exists(key)
+            new_cas = next(_cas)
+            self._store.docs[key] = (pickled, new_cas, _expiry(ttl))
+        return Result(key, cas=new_cas)
+
+    def _remove(self, key, cas=0, quiet=False):
+        with self._store.lock:
+            entry = self._store.live(key)
+            if entry is None:
+                if quiet:
+                    return Result(key, success=False, rc=NotFoundError.CODE)
+                raise self._not_found(key)
+            if cas and entry[1] != cas:
+                raise self._exists(key)
+            del self._store.docs[key]
+        return Result(key, cas=entry[1])
+
+    def _touch(self, key, ttl=0):
+        with self._store.lock:
+            entry = self._store.live(key)
+            if entry is None:
+                raise self._not_found(key)
+            new_cas = next(_cas)
+            self._store.docs[key] = (entry[0], new_cas, _expiry(ttl))
+        return Result(key, cas=new_cas)
+
+    def _counter(self, key, delta=1, initial=None, ttl=0):
+        with self._store.lock:
+            entry = self._store.live(key)
+            if entry is None:
+                if initial is None:
+                    raise self._not_found(key)
+                value, expires = initial, _expiry(ttl)
+            else:
+                value = max(int(pickle.loads(entry[0])) + delta, 0)
+                expires = entry[2]
+            new_cas = next(_cas)
+            self._store.docs[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), new_cas, expires)
+        return Result(key, value, new_cas)
+
+    def get(self, key, ttl=0, quiet=None, **kwargs):
+        self._wait()
+        return self._get(key, ttl, quiet)
+
+    def set(self, key, value, cas=0, ttl=0, **kwargs):
+        self._wait()
+        return self._store_value(key, value, cas, ttl)
+
+    upsert = set
+
+    def add(self, key, value, ttl=0, **kwargs):
+        self._wait()
+        return self._store_value(key, value, ttl=ttl, mode='add')
+
+    insert = add
+
+    def replace(self, key, value, cas=0, ttl=0, **kwargs):
+        self._wait()
+        return self._store_value(key, value, cas, ttl, mode='replace')
+
+    def remove(self, key, cas=0, quiet=None, **kwargs):
+        self._wait()
+        return self._remove(key, cas, quiet)
+
+    delete = remove
+
+    def touch(self, key, ttl=0, **kwargs):
+        self._wait()
+        return self._touch(key, ttl)
+
+    def counter(self, key, delta=1, initial=None, ttl=0, **kwargs):
+        self._wait()
+        return self._counter(key, delta, initial, ttl)
+
+    # many documents, one round trip
+
+    def _multi(self, keys, operation, quiet):
+        results = MultiResult()
+        failed = None
+        for key in keys:
+            try:
+                results[key] = operation(key)
+            except CouchbaseError as e:
+                results[key] = Result(key, success=False, rc=e.CODE)
+                failed = failed or e
+        if failed is not None and not quiet:
+            raise type(failed)({'message': str(failed), 'all_results': results})
+        return results
+
+    def get_multi(self, keys, ttl=0, quiet=None, **kwargs):
+        self._wait()
+        return self._multi(keys, lambda key: self._get(key, ttl, quiet), quiet)
+
+    def set_multi(self, kv, ttl=0, **kwargs):
+        self._wait()
+        docs = _multi_docs(kv)
+        return self._multi(docs, lambda key: self._store_value(key, docs[key][0], docs[key][1], ttl), False)
+
+    upsert_multi = set_multi
+
+    def add_multi(self, kv, ttl=0, **kwargs):
+        self._wait()
+        return self._multi(kv, lambda key: self._store_value(key, kv[key], ttl=ttl, mode='add'), False)
+
+    insert_multi = add_multi
+
+    def replace_multi(self, kv, ttl=0, **kwargs):
+        self._wait()
+        docs = _multi_docs(kv)
+        return self._multi(docs, lambda key: self._store_value(key, docs[key][0], docs[key][1], ttl,
+                                                               mode='replace'), False)
+
+    def remove_multi(self, keys, quiet=None, **kwargs):
+        self._wait()
+        return self._multi(keys, lambda key: self._remove(key, quiet=quiet), quiet)
+
+    delete_multi = remove_multi
+
+    def touch_multi(self, keys, ttl=0, **kwargs):
+        self._wait()
+        return self._multi(keys, lambda key: self._touch(key, ttl), False)
+
+    def counter_multi(self, keys, delta=1, initial=None, ttl=0, **kwargs):
+        self._wait()
+        return self._multi(keys, lambda key: self._counter(key, delta, initial, ttl), False)
+
+    # sub-document
+
+    def lookup_in(self, key, *specs, **kwargs):
+        self._wait()
+        doc = self._get(key).value
+        table = _spec_ops()
+        found = []
+        for spec in specs:
+            name = table[spec[0]][0]
+            parts = _split_path(spec[1])
+            try:
+                container = _resolve(doc, parts)
+            except SubdocPathNotFoundError:
+                found.append((spec[1], False, None))
+                continue
+            present = _has(container, parts[-1])
+            if name == 'exists':
+                found.append((spec[1], present, present))
+            else:
+                found.append((spec[1], present, container[parts[-1]] if present else None))
+        return SubdocResult(key, self._cas_of(key), found)
+
+    def _cas_of(self, key):
+        with self._store.lock:
+            entry = self._store.live(key)
+        return entry[1] if entry is not None else 0
+
+    def mutate_in(self, key, *specs, **kwargs):
+        self._wait()
+        cas = kwargs.get('cas', 0)
+        with self._store.lock:
+            entry = self._store.live(key)
+            if entry is None:
+                raise self._not_found(key)
+            if cas and entry[1] != cas:
+                raise self._exists(key)
+            doc = pickle.loads(entry[0])
+            table = _spec_ops()
+            for spec in specs:
+                name, value_at, multi = table[spec[0]]
+                self._mutate(doc, name, _split_path(spec[1]), _spec_value(spec, value_at, multi))
+            new_cas = next(_cas)
+            self._store.docs[key] = (pickle.dumps(doc, pickle.HIGHEST_PROTOCOL), new_cas,
+                                     _expiry(kwargs['ttl']) if kwargs.get('ttl') else entry[2])
+        return SubdocResult(key, new_cas, [])
+
+    def _mutate(self, doc, name, parts, value):
+        container = _resolve(doc, parts, create=name not in ('replace', 'remove'))
+        last = parts[-1]
+        present = _has(container, last)
+        if name == 'insert' and present:
+            raise SubdocPathExistsError({'message': 'path exists'})
+        if name in ('replace', 'remove') and not present:
+            raise SubdocPathNotFoundError({'message': 'path not found'})
+        if name in ('upsert', 'insert', 'replace'):
+            container[last] = value
+        elif name == 'remove':
+            del container[last]
+        elif name == 'counter':
+            container[last] = (container[last] if present else 0) + value
+        else:
+            if not present:
+                container[last] = []
+            array = container[last]
+            values = value if isinstance(value, list) and name != 'array_addunique' else [value]
+            if name == 'array_append':
+                array.extend(values)
+            elif name == 'array_prepend':
+                array[0:0] = values
+            elif value in array:
+                raise SubdocPathExistsError({'message': 'value exists in array'})
+            else:
+                array.append(value)
+
+    # N1QL
+
+    def n1ql_query(self, query, *args, **kwargs):
+        """
+        Runs a couchbase.n1ql.N1QLQuery (or a statement and its positional
+        parameters) and returns the rows, see the module docstring for the
+        statements understood.
+        """
+        self._wait()
+        if isinstance(query, string_types):
+            statement, params = query, list(args)
+        else:
+            body = getattr(query, '_body', None) or {}
+            statement = body.get('statement', getattr(query, 'statement', None))
+            params = list(body.get('args', getattr(query, 'params', ())))
+        statement = statement.strip()
+        match = _SELECT.match(statement)
+        if match is not None:
+            return self._select(match, params)
+        match = _UPDATE.match(statement)
+        if match is not None:
+            return self._update(match, params)
+        raise _Unsupported('N1QL statement not supported by fake buckets: %s' % statement)
+
+    def _keys(self, match, params):
+        if match.group('keys') is None:
+            with self._store.lock:
+                return sorted(self._store.docs)
+        keys = params[int(match.group('keys')) - 1]
+        return [keys] if isinstance(keys, string_types) else list(keys)
+
+    def _rows(self, keys, where):
+        rows = []
+        for key in keys:
+            with self._store.lock:
+                entry = self._store.live(key)
+            if entry is None:
+                continue
+            row = (key, entry[1], pickle.loads(entry[0]))
+            if isinstance(row[2], dict) and where(row):
+                rows.append(row)
+        return rows
+
+    def _select(self, match, params):
+        compiled = _Statement(match.group('alias'), params)
+        where = compiled.condition(match.group('where') or 'TRUE')
+        rows = self._rows(self._keys(match, params), where)
+        if match.group('select') == 'COUNT(*) AS `count`':
+            return [{'count': len(rows)}]
+        if match.group('order'):
+            for value, descending in reversed(compiled.order(match.group('order'))):
+                rows.sort(key=lambda row: _collation(value(row)), reverse=descending)
+        offset = int(match.group('offset') or 0)
+        if match.group('limit') is not None:
+            rows = rows[offset:offset + int(match.group('limit'))]
+        else:
+            rows = rows[offset:]
+        project = compiled.projection(match.group('select'))
+        return [project(row) for row in rows]
+
+    def _update(self, match, params):
+        compiled = _Statement(match.group('alias'), params)
+        where = compiled.condition(match.group('where') or 'TRUE')
+        assignments = compiled.assignments(match.group('set'))
+        project = compiled.projection(match.group('returning')) if match.group('returning') else None
+        results = []
+        for key in self._keys(match, params):
+            with self._store.lock:
+                entry = self._store.live(key)
+                if entry is None:
+                    continue
+                doc = pickle.loads(entry[0])
+                if not isinstance(doc, dict) or not where((key, entry[1], doc)):
+                    continue
+                for names, value in assignments:
+                    _assign(doc, names, value((key, entry[1], doc)))
+                new_cas = next(_cas)
+                self._store.docs[key] = (pickle.dumps(doc, pickle.HIGHEST_PROTOCOL), new_cas, entry[2])
+            if project is not None:
+                results.append(project((key, new_cas, doc)))
+        return results
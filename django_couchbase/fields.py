@@ -13,9 +13,19 @@ class ModelReferenceField(models.CharField):
         return 'ModelReferenceField'
 
 class PartialReferenceField(models.CharField):
+    """
+    Reference that also stores some attributes of the referenced object,
+    ``links`` maps the stored key to the attribute name:
 
-    def __init__(self, embedded_model=None, *args, **kwargs):
+        author = PartialReferenceField(Author, links={'author_name': 'name'})
+
+    The copies are updated when the referenced object changes, see
+    django_couchbase.denormalize.
+    """
+
+    def __init__(self, embedded_model=None, links=None, *args, **kwargs):
         self.embedded_model = embedded_model
+        self.links = links or {}
         kwargs.setdefault('default', None)
         super(PartialReferenceField, self).__init__(*args, **kwargs)
 
@@ -0,0 +1,110 @@
+"""
+Request-scoped identity map for CBModel documents.
+
+While a map is active, documents loaded through ``CBModel.get``,
+``get_many``, ``load_related``, ``load_related_list`` or ``Model(id)`` are
+remembered by bucket and id, and later loads of the same document in the
+scope are served from memory. Saved documents replace the remembered
+instance, deleted ones are forgotten.
+
+Enable it for every request with the middleware
+
+    MIDDLEWARE_CLASSES = (
+        # ...
+        'django_couchbase.identity.IdentityMapMiddleware',
+    )
+
+or for a block of code
+
+    with identity_map():
+        ...
+
+The active map is held in a context variable, so coroutines (see
+django_couchbase.aio) and threads each see their own. Python 2 falls back
+to a thread local.
+"""
+from contextlib import contextmanager
+from threading import local
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+
+class _ThreadLocalVar(local):
+    """
+    The part of ContextVar used here, for Python 2.
+    """
+
+    def get(self):
+        return getattr(self, 'value', None)
+
+    def set(self, value):
+        self.value = value
+
+
+if ContextVar is not None:
+    _state = ContextVar('django_couchbase_identity_map', default=None)
+else:
+    _state = _ThreadLocalVar()
+
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self._objs = {}
+
+    def get(self, model, id):
+        obj = self._objs.get((model.bucket, id))
+        if obj is not None and isinstance(obj, model):
+            return obj
+        return None
+
+    def add(self, obj, replace=False):
+        key = (obj.bucket, obj.id)
+        if replace or key not in self._objs:
+            self._objs[key] = obj
+        return self._objs[key]
+
+    def discard(self, obj):
+        self._objs.pop((obj.bucket, obj.id), None)
+
+    def clear(self):
+        self._objs.clear()
+
+
+def current():
+    """
+    Returns the active IdentityMap, or None.
+    """
+    return _state.get()
+
+
+@contextmanager
+def identity_map():
+    outer = current()
+    if outer is not None:
+        yield outer
+        return
+    active = IdentityMap()
+    _state.set(active)
+    try:
+        yield active
+    finally:
+        _state.set(None)
+
+
+class IdentityMapMiddleware(MiddlewareMixin):
+
+    def process_request(self, request):
+        _state.set(IdentityMap())
+
+    def process_response(self, request, response):
+        _state.set(None)
+        return response
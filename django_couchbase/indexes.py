@@ -0,0 +1,128 @@
+"""
+Secondary (GSI) indexes derived from CBModel declarations.
+
+Every stored model gets an index on ``doc_type``, one on ``META().id`` (the
+keyset paging of ``cb_export``), one index per field
+declared with ``db_index=True`` or used by a PartialReferenceField with
+links, and the composite indexes listed in its ``indexes`` attribute. All of
+them are partial indexes limited to the model's documents:
+
+    class Book(CBModel):
+        ...
+        name = models.CharField(max_length=45, db_index=True)
+        indexes = [CBIndex(['publisher', 'pages'])]
+
+    CREATE INDEX `book_name_idx` ON `default`(`name`) WHERE `doc_type` = "book" WITH {"defer_build": true}
+
+Indexes are created with deferred builds and then built together with one
+BUILD INDEX statement per bucket (see the ``cb_indexes`` command).
+"""
+from django_couchbase.connection import bucket_name
+from django_couchbase.fields import PartialReferenceField
+from django_couchbase.query import LOOKUP_SEP, doc_type_condition, quote
+
+
+class CBIndex(object):
+
+    def __init__(self, fields, name=None):
+        self.fields = list(fields)
+        self.name = name
+
+    def get_name(self, doc_type):
+        return self.name or '%s_%s_idx' % (doc_type, '_'.join(self.fields).replace(LOOKUP_SEP, '_'))
+
+
+META_ID = 'META().id'
+
+
+def key_path(name):
+    if name == META_ID:
+        return name
+    return '.'.join(quote(part) for part in name.split(LOOKUP_SEP))
+
+
+def model_indexes(model):
+    """
+    Returns the CBIndex list declared by ``model``, named.
+    """
+    from django_couchbase.models import DOC_TYPE_FIELD_NAME
+    doc_type = model().get_doc_type()
+    indexes = [CBIndex([DOC_TYPE_FIELD_NAME]), CBIndex([META_ID], '%s_id_idx' % doc_type)]
+    indexes.extend(CBIndex([field.name]) for field in model._meta.fields if field.db_index)
+    # denormalized copies are updated by looking up the referencing documents
+    indexes.extend(CBIndex([field.name]) for field in model._meta.fields
+                   if isinstance(field, PartialReferenceField) and field.links and not field.db_index)
+    indexes.extend(getattr(model, 'indexes', None) or [])
+    named = []
+    for index in indexes:
+        named.append(CBIndex(index.fields, index.get_name(doc_type)))
+    return named
+
+
+def create_statement(model, index):
+    from django_couchbase.models import DOC_TYPE_FIELD_NAME
+    return 'CREATE INDEX %s ON %s(%s) WHERE %s WITH {"defer_build": true}' % (
+        quote(index.name),
+        quote(bucket_name(model.bucket)),
+        ', '.join(key_path(f) for f in index.fields),
+        doc_type_condition(model, quote(DOC_TYPE_FIELD_NAME)))
+
+
+def build_statement(bucket, names):
+    return 'BUILD INDEX ON %s(%s)' % (quote(bucket), ', '.join(quote(n) for n in names))
+
+
+def drop_statement(bucket, name):
+    return 'DROP INDEX %s.%s' % (quote(bucket), quote(name))
+
+
+EXISTING_INDEXES = 'SELECT `name`, `index_key`, `state` FROM system:indexes WHERE `keyspace_id` = $1'
+
+# system:indexes state of an index created with defer_build and not built yet
+DEFERRED = 'deferred'
+
+
+def _normalize_key(key):
+    key = key.replace('`', '').replace(' ', '')
+    # system:indexes reports META().id as "(meta().`id`)"
+    if key.startswith('(') and key.endswith(')'):
+        key = key[1:-1]
+    if key.lower().startswith('meta('):
+        key = key.lower()
+    return key
+
+
+def _normalize_keys(keys):
+    return [_normalize_key(key) for key in keys]
+
+
+def plan(models, existing):
+    """
+    Compares the indexes declared by ``models`` with ``existing``, a dict of
+    bucket name -> {index name: system:indexes row with its ``index_key`` and
+    ``state``}.
+
+    Returns (creates, drops, builds): creates maps bucket name to a list of
+    (index name, CREATE INDEX statement), drops maps bucket name to the names
+    of declared indexes whose keys changed and must be recreated, builds maps
+    bucket name to the indexes to build: the created ones and the declared
+    ones left deferred, e.g. by an earlier run without its BUILD INDEX.
+    """
+    creates = {}
+    drops = {}
+    builds = {}
+    for model in models:
+        bucket = bucket_name(model.bucket)
+        present = existing.get(bucket, {})
+        for index in model_indexes(model):
+            row = present.get(index.name)
+            if row is not None:
+                wanted = _normalize_keys(key_path(f) for f in index.fields)
+                if _normalize_keys(row['index_key']) == wanted:
+                    if row.get('state') == DEFERRED:
+                        builds.setdefault(bucket, []).append(index.name)
+                    continue
+                drops.setdefault(bucket, []).append(index.name)
+            creates.setdefault(bucket, []).append((index.name, create_statement(model, index)))
+            builds.setdefault(bucket, []).append(index.name)
+    return creates, drops, builds
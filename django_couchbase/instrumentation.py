@@ -0,0 +1,247 @@
+"""
+Instrumentation of the Couchbase operations done by CBModel and
+CouchbaseCache.
+
+With ``CB_INSTRUMENTATION = True`` the buckets handed out for ``CB_BUCKETS``
+aliases (and the cache client of every CouchbaseCache, or only of those with
+the 'instrument' option) are wrapped in an InstrumentedBucket. After every
+operation it sends the ``operation_finished`` signal with
+
+    op          'get', 'set_multi', 'counter', 'n1ql_query', ...
+    bucket      the bucket name
+    keys        number of keys (rows for queries)
+    bytes       size of the values written or read, if CB_INSTRUMENTATION_BYTES
+    duration    seconds
+    outcome     'ok', 'miss', 'conflict', 'partial' or 'error'
+
+Errors the caller swallows, like the ones of CouchbaseCache.delete, are
+reported too. When instrumentation is off the buckets are not wrapped and
+nothing is measured.
+
+``collector`` aggregates the signals and renders them for Prometheus or
+statsd:
+
+    from django_couchbase.instrumentation import collector
+    collector.prometheus()
+
+"""
+import json
+import threading
+import time
+
+from couchbase.exceptions import KeyExistsError, NotFoundError
+from django.conf import settings
+from django.dispatch import Signal
+from six import binary_type, text_type
+
+_now = getattr(time, 'perf_counter', time.time)
+
+operation_finished = Signal()
+
+OPERATIONS = frozenset([
+    'get', 'set', 'add', 'replace', 'upsert', 'remove', 'delete', 'touch', 'counter',
+    'lookup_in', 'mutate_in',
+    'get_multi', 'set_multi', 'add_multi', 'replace_multi', 'upsert_multi',
+    'remove_multi', 'delete_multi', 'touch_multi', 'counter_multi',
+])
+
+# operations whose second argument (or mapping values) is the written value
+WRITES = frozenset(['set', 'add', 'replace', 'upsert',
+                    'set_multi', 'add_multi', 'replace_multi', 'upsert_multi'])
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def enabled():
+    return getattr(settings, 'CB_INSTRUMENTATION', False)
+
+
+def _size(value):
+    if isinstance(value, (binary_type, text_type)):
+        return len(value)
+    try:
+        return len(json.dumps(value, default=text_type))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _multi_values(target):
+    if isinstance(target, dict):
+        return target.values()
+    # a couchbase.items.ItemOptionDict
+    return [item.value for item, options in target]
+
+
+def _outcome(error):
+    if isinstance(error, NotFoundError):
+        return 'miss'
+    if isinstance(error, KeyExistsError):
+        return 'conflict'
+    return 'error'
+
+
+class InstrumentedBucket(object):
+    """
+    Proxy to a bucket that reports every operation in OPERATIONS, and every
+    N1QL query once its rows are consumed.
+    """
+
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._bucket, attr)
+        if attr in OPERATIONS:
+            return self._wrap(attr, value)
+        if attr == 'n1ql_query':
+            return self._wrap_query(value)
+        return value
+
+    def __setattr__(self, attr, value):
+        if attr in ('_bucket', '_name'):
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._bucket, attr, value)
+
+    def _wrap(self, op, method):
+        measure = getattr(settings, 'CB_INSTRUMENTATION_BYTES', False)
+
+        def call(*args, **kwargs):
+            target = args[0] if args else None
+            multi = op.endswith('_multi')
+            keys = len(target) if multi and target is not None else 1
+            size = 0
+            if measure and op in WRITES:
+                if multi:
+                    size = sum(_size(v) for v in _multi_values(target))
+                elif len(args) > 1:
+                    size = _size(args[1])
+            start = _now()
+            try:
+                rv = method(*args, **kwargs)
+            except Exception as e:
+                self._send(op, keys, size, _now() - start, _outcome(e))
+                raise
+            duration = _now() - start
+            outcome = 'ok'
+            if multi:
+                results = list(rv.values())
+                if any(not r.success for r in results):
+                    outcome = 'partial'
+                if measure and op not in WRITES:
+                    size = sum(_size(r.value) for r in results if r.success and hasattr(r, 'value'))
+            elif measure and op not in WRITES and hasattr(rv, 'value'):
+                size = _size(rv.value)
+            self._send(op, keys, size, duration, outcome)
+            return rv
+        return call
+
+    def _wrap_query(self, method):
+        def query(*args, **kwargs):
+            start = _now()
+            rows = 0
+            outcome = 'ok'
+            try:
+                for row in method(*args, **kwargs):
+                    rows += 1
+                    yield row
+            except GeneratorExit:
+                # the consumer stopped early (first(), exists()), not an error
+                raise
+            except Exception as e:
+                outcome = _outcome(e)
+                raise
+            finally:
+                self._send('n1ql_query', rows, 0, _now() - start, outcome)
+        return query
+
+    def _send(self, op, keys, size, duration, outcome):
+        operation_finished.send(sender=InstrumentedBucket, op=op, bucket=self._name, keys=keys,
+                                bytes=size, duration=duration, outcome=outcome)
+
+
+class MetricsCollector(object):
+    """
+    Thread-safe counters and latency histograms per (op, bucket, outcome).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def __call__(self, sender, op, bucket, keys, bytes, duration, outcome, **kwargs):
+        self.record(op, bucket, keys, bytes, duration, outcome)
+
+    def record(self, op, bucket, keys, size, duration, outcome):
+        label = (op, bucket, outcome)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = {
+                    'count': 0, 'keys': 0, 'bytes': 0, 'seconds': 0.0,
+                    'histogram': [0] * len(self.buckets),
+                }
+            series['count'] += 1
+            series['keys'] += keys
+            series['bytes'] += size
+            series['seconds'] += duration
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    series['histogram'][i] += 1
+                    break
+
+    def snapshot(self):
+        """
+        Returns {(op, bucket, outcome): series dict}, copied.
+        """
+        with self._lock:
+            return dict((label, dict(series, histogram=list(series['histogram'])))
+                        for label, series in self._series.items())
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def prometheus(self, prefix='couchbase'):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            '# TYPE %s_operations_total counter' % prefix,
+            '# TYPE %s_keys_total counter' % prefix,
+            '# TYPE %s_bytes_total counter' % prefix,
+            '# TYPE %s_operation_seconds histogram' % prefix,
+        ]
+        for (op, bucket, outcome), series in sorted(self.snapshot().items()):
+            labels = 'op="%s",bucket="%s",outcome="%s"' % (op, bucket, outcome)
+            lines.append('%s_operations_total{%s} %d' % (prefix, labels, series['count']))
+            lines.append('%s_keys_total{%s} %d' % (prefix, labels, series['keys']))
+            lines.append('%s_bytes_total{%s} %d' % (prefix, labels, series['bytes']))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['histogram']):
+                cumulative += count
+                lines.append('%s_operation_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, bound, cumulative))
+            lines.append('%s_operation_seconds_bucket{%s,le="+Inf"} %d' % (prefix, labels, series['count']))
+            lines.append('%s_operation_seconds_sum{%s} %f' % (prefix, labels, series['seconds']))
+            lines.append('%s_operation_seconds_count{%s} %d' % (prefix, labels, series['count']))
+        return '\n'.join(lines) + '\n'
+
+    def statsd(self, prefix='couchbase'):
+        """
+        The totals as statsd gauge lines, ``prefix.bucket.op.outcome.count:3|g``.
+        """
+        lines = []
+        for (op, bucket, outcome), series in sorted(self.snapshot().items()):
+            name = '%s.%s.%s.%s' % (prefix, bucket, op, outcome)
+            lines.append('%s.count:%d|g' % (name, series['count']))
+            lines.append('%s.keys:%d|g' % (name, series['keys']))
+            lines.append('%s.bytes:%d|g' % (name, series['bytes']))
+            lines.append('%s.ms:%f|g' % (name, series['seconds'] * 1000))
+        return lines
+
+
+collector = MetricsCollector()
+operation_finished.connect(collector, weak=False, dispatch_uid='django_couchbase.collector')
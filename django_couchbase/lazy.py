@@ -0,0 +1,82 @@
+"""
+Lazily hydrated lists of embedded models.
+
+A model with ``lazy_embedded_lists = True`` (or a list of field names) gets
+a LazyEmbeddedList instead of a list for its ListField(EmbeddedModelField)
+fields when loaded. The stored dicts are kept as they are and an item is
+only turned into its model on access; ``to_dict`` writes the items that were
+never accessed back unchanged.
+"""
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
+
+# marks the items that were not turned into models yet
+_UNHYDRATED = object()
+
+
+class LazyEmbeddedList(MutableSequence):
+
+    def __init__(self, nested_klass, raw):
+        self.nested_klass = nested_klass
+        self._raw = list(raw)
+        self._items = [_UNHYDRATED] * len(self._raw)
+
+    def _hydrate(self, index):
+        item = self._items[index]
+        if item is _UNHYDRATED:
+            item = self.nested_klass()
+            item.from_dict(self._raw[index])
+            self._items[index] = item
+        return item
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._hydrate(i) for i in range(*index.indices(len(self._raw)))]
+        return self._hydrate(range(len(self._raw))[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._items[index] = value
+            self._raw[index] = [None] * len(value)
+        else:
+            self._items[index] = value
+            self._raw[index] = None
+
+    def __delitem__(self, index):
+        del self._items[index]
+        del self._raw[index]
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+        self._raw.insert(index, None)
+
+    def __eq__(self, other):
+        if not isinstance(other, (LazyEmbeddedList, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyEmbeddedList of %d %s>' % (len(self), self.nested_klass.__name__)
+
+    @property
+    def hydrated_count(self):
+        return sum(1 for item in self._items if item is not _UNHYDRATED)
+
+    def to_dicts(self):
+        """
+        The stored form: untouched items as loaded, the others encoded.
+        """
+        return [raw if item is _UNHYDRATED else None if item is None else item.to_dict()
+                for raw, item in zip(self._raw, self._items)]
@@ -0,0 +1,89 @@
+"""
+Bounded in-process LRU used by CouchbaseCache as a first level in front of
+the bucket.
+
+Values are kept pickled, like Django's locmem backend, so callers never share
+mutable objects through the cache and the memory used can be counted in
+bytes. Entries expire after a short timeout, which bounds how stale a value
+changed by another process can be.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from six.moves import cPickle as pickle
+
+MISSING = object()
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class LocalCache(object):
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, timeout=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value or MISSING.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires, pickled = entry
+            if expires <= _now():
+                self._bytes -= len(pickled)
+                self.misses += 1
+                return MISSING
+            # re-insert as most recently used
+            self._data[key] = entry
+            self.hits += 1
+        return pickle.loads(pickled)
+
+    def set(self, key, value):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._data[key] = (_now() + self.timeout, pickled)
+            self._bytes += len(pickled)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._data),
+                'bytes': self._bytes,
+            }
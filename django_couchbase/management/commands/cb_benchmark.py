@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_couchbase.benchmark import SCENARIOS, compare, load_baseline, run, save_baseline
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks CBModel and CouchbaseCache against in-memory fake buckets, '
+            'optionally saving or comparing with a baseline file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help='Scenarios to run (default: all): %s.' % ', '.join(SCENARIOS))
+        parser.add_argument('--number', type=int, default=200,
+                            help='Operations per run.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per scenario, the median is reported.')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Simulated round-trip latency of the fake buckets, in seconds.')
+        parser.add_argument('--save', metavar='PATH',
+                            help='Store the results as a baseline.')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Compare the results with a stored baseline.')
+        parser.add_argument('--max-regression', type=float, default=None,
+                            help='With --compare, fail if a scenario got slower by more '
+                                 'than this fraction (0.1 = 10%%).')
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        results = run(options['scenarios'] or None, number=options['number'],
+                      repeat=options['repeat'], latency=options['latency'])
+        self.stdout.write('%-16s %12s' % ('scenario', 'us/op'))
+        for name, us in results.items():
+            self.stdout.write('%-16s %12.2f' % (name, us))
+
+        if options['save']:
+            save_baseline(options['save'], results)
+            self.stdout.write('Baseline saved to %s' % options['save'])
+
+        if options['compare']:
+            rows = compare(results, load_baseline(options['compare']))
+            self.stdout.write('')
+            self.stdout.write('%-16s %12s %12s %8s' % ('scenario', 'baseline', 'current', 'change'))
+            regressions = []
+            for name, before, after, change in rows:
+                self.stdout.write('%-16s %12.2f %12.2f %+7.1f%%' % (name, before, after, change * 100))
+                if options['max_regression'] is not None and change > options['max_regression']:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError('slower than the baseline: %s' % ', '.join(regressions))
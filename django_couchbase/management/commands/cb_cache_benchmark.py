@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from django_couchbase.cache_codecs import CODECS, benchmark
+
+
+def sample_payloads():
+    record = {
+        'id': 'ord::3b2f8a', 'doc_type': 'order', 'total': 1299.5, 'paid': True,
+        'customer': {'name': 'Aswin', 'email': 'aswin@example.com', 'tags': ['vip', 'b2b']},
+        'items': [{'sku': 'sku-%d' % i, 'qty': i % 5 + 1, 'price': 9.99 * i} for i in range(20)],
+    }
+    return {
+        'small dict': {'enabled': True, 'rollout': 25, 'name': 'new-checkout'},
+        'record': record,
+        'record list': [record] * 200,
+        'html fragment': '<li class="item">%s</li>' % ('x' * 50) * 1000,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares encode/decode time and size of the CouchbaseCache serializers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=1000,
+                            help='Iterations per codec and payload.')
+        parser.add_argument('--codec', action='append', dest='codecs', choices=list(CODECS),
+                            help='Codec to measure, may be repeated (default: all importable).')
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-8s %-14s %10s %12s %12s' % ('codec', 'payload', 'bytes', 'encode us', 'decode us'))
+        for name, label, size, encode, decode in benchmark(sample_payloads(), options['codecs'],
+                                                            options['number']):
+            self.stdout.write('%-8s %-14s %10d %12.1f %12.1f' % (name, label, size, encode, decode))
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_couchbase.models import get_model
+from django_couchbase.transfer import (EXPORT_PAGE_SIZE, dump_line, export_pages, open_stream,
+                                       read_checkpoint, write_checkpoint)
+
+
+class Command(BaseCommand):
+    help = 'Streams the documents of a CBModel doc type to an NDJSON file (gzip for .gz).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Model class name, dotted path or doc_type.')
+        parser.add_argument('--output', '-o', default='-',
+                            help='File to write, .gz is compressed (default: stdout).')
+        parser.add_argument('--page-size', type=int, default=EXPORT_PAGE_SIZE,
+                            help='Documents per query.')
+        parser.add_argument('--checkpoint', metavar='PATH',
+                            help='Records the last exported id; an existing checkpoint resumes '
+                                 'the export, appending to the output.')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_model(options['model'])
+        except LookupError as e:
+            raise CommandError(str(e))
+        checkpoint = options['checkpoint']
+        if checkpoint and options['output'] == '-':
+            raise CommandError('--checkpoint needs --output')
+        state = read_checkpoint(checkpoint) or {'last_id': '', 'count': 0}
+        mode = 'at' if state['count'] else 'wt'
+
+        start = time.time()
+        exported = 0
+        out = open_stream(options['output'], mode)
+        try:
+            for page in export_pages(model, state['last_id'], options['page_size']):
+                for id, doc in page:
+                    out.write(dump_line(id, doc))
+                out.flush()
+                exported += len(page)
+                state = {'last_id': page[-1][0], 'count': state['count'] + len(page)}
+                write_checkpoint(checkpoint, state)
+                self.stderr.write('%d documents, %.0f/s' % (
+                    state['count'], exported / max(time.time() - start, 1e-6)))
+        finally:
+            if options['output'] != '-':
+                out.close()
+        self.stderr.write('Exported %d documents of %s.' % (state['count'], model().get_doc_type()))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_couchbase.models import get_model
+from django_couchbase.transfer import (IMPORT_CHUNK_SIZE, IMPORT_CONCURRENCY, import_chunks,
+                                       open_stream, read_checkpoint, read_chunks, write_checkpoint)
+
+
+class Command(BaseCommand):
+    help = 'Writes the documents of an NDJSON file made by cb_export (gzip for .gz) to the bucket.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Model class name, dotted path or doc_type.')
+        parser.add_argument('input', help='File to read, .gz is decompressed, - is stdin.')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                            help='Documents per set_multi.')
+        parser.add_argument('--concurrency', type=int, default=IMPORT_CONCURRENCY,
+                            help='Chunks written at the same time.')
+        parser.add_argument('--skip-existing', action='store_true', default=False,
+                            help='Only add documents that do not exist yet (counted as errors).')
+        parser.add_argument('--checkpoint', metavar='PATH',
+                            help='Records the lines imported so far; an existing checkpoint '
+                                 'resumes the import.')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_model(options['model'])
+        except LookupError as e:
+            raise CommandError(str(e))
+        checkpoint = options['checkpoint']
+        state = read_checkpoint(checkpoint) or {'line': 0, 'written': 0, 'errors': 0}
+
+        start = time.time()
+        written = 0
+        stream = open_stream(options['input'], 'rt')
+        try:
+            chunks = read_chunks(stream, options['chunk_size'], skip=state['line'])
+            for line, ok, failed in import_chunks(model, chunks, max(options['concurrency'], 1),
+                                                  options['skip_existing']):
+                written += ok
+                state = {'line': line, 'written': state['written'] + ok,
+                         'errors': state['errors'] + failed}
+                write_checkpoint(checkpoint, state)
+                self.stderr.write('%d written, %d errors, %.0f/s' % (
+                    state['written'], state['errors'], written / max(time.time() - start, 1e-6)))
+        finally:
+            if options['input'] != '-':
+                stream.close()
+        self.stderr.write('Imported %d documents of %s, %d errors.' % (
+            state['written'], model().get_doc_type(), state['errors']))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from django_couchbase.connection import bucket_name
+from django_couchbase.indexes import EXISTING_INDEXES, build_statement, drop_statement, plan
+from django_couchbase.models import get_models
+from django_couchbase.query import n1ql_executor
+
+
+class Command(BaseCommand):
+    help = 'Creates the secondary indexes declared by the CBModel classes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true', default=False,
+                            help='Run the statements instead of only printing them.')
+
+    def handle(self, *args, **options):
+        executors = {}
+        for model in get_models():
+            executors.setdefault(bucket_name(model.bucket), n1ql_executor(model))
+
+        existing = {}
+        for bucket, execute in executors.items():
+            existing[bucket] = dict((row['name'], row)
+                                    for row in execute(EXISTING_INDEXES, [bucket]))
+
+        creates, drops, builds = plan(get_models(), existing)
+        if not builds:
+            self.stdout.write('Indexes are up to date.')
+            return
+
+        for bucket, execute in executors.items():
+            statements = [drop_statement(bucket, name) for name in drops.get(bucket, [])]
+            statements.extend(statement for name, statement in creates.get(bucket, []))
+            if builds.get(bucket):
+                statements.append(build_statement(bucket, builds[bucket]))
+            for statement in statements:
+                self.stdout.write(statement)
+                if options['apply']:
+                    for _ in execute(statement, []):
+                        pass
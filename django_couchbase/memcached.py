@@ -12,7 +12,40 @@ settings
                                 'operation_timeout': 20.5,
                                 'gevent_support': False,
                                 'format': 'PICKLE',
-                                'admin:pwd': 'admin:pwd'
+                                'admin:pwd': 'admin:pwd',
+
+                    # optional in-process LRU in front of the bucket, shared
+                    # by the backends of all threads for this location,
+                    # 'timeout' (seconds) is how stale a local value can get
+                    #            'local_cache': {'max_entries': 1000,
+                    #                            'max_bytes': 16777216,
+                    #                            'timeout': 1.0},
+
+                    # compress values of at least compress_min_size bytes,
+                    # 'auto' uses zstd, lz4 or zlib, whichever is importable
+                    #            'compression': 'auto',
+                    #            'compress_min_size': 16384,
+
+                    # serialize values with a faster codec instead of 'format':
+                    # 'msgpack', 'orjson', 'pickle5', 'pickle', 'json' or a
+                    # dotted path to an object with dumps/loads
+                    #            'serializer': 'msgpack',
+
+                    # get_many reads in chunks and does not touch the keys
+                    # unless sliding expiration is wanted
+                    #            'get_many_chunk_size': 1000,
+                    #            'sliding_expiration': False,
+
+                    # get_or_set: lock key ttl, how long workers without a
+                    # value wait for the one recomputing it, and how long a
+                    # value stays available after it is due
+                    #            'stampede_lock_timeout': 10,
+                    #            'stampede_wait': 1.0,
+                    #            'stampede_grace': 60,
+
+                    # report every operation to django_couchbase.instrumentation,
+                    # defaults to settings.CB_INSTRUMENTATION
+                    #            'instrument': True,
                                 
                     # couchbase-cli need admin and password,
                     # but for security issue... be careful to use                    
@@ -27,11 +60,14 @@ settings
 
 """
 import logging
+import math
+import random
+import time
 import warnings
-from threading import local
+from threading import Lock, local
 
 from django.conf import settings
-from django.core.cache.backends.base import InvalidCacheBackendError
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, InvalidCacheBackendError
 from django.core.cache.backends.memcached import BaseMemcachedCache
 
 
@@ -43,8 +79,51 @@ except Exception as e:
 from couchbase import connection,exceptions
 import couchbase
 
+from django_couchbase import fake, instrumentation
+from django_couchbase.local_cache import LocalCache, MISSING
+from django_couchbase.transcoder import CacheTranscoder, DEFAULT_MIN_SIZE
+
 log = logging.getLogger('django.couchbase')
 
+GET_MANY_CHUNK_SIZE = 1000
+
+# get_or_set entries are dicts holding the time they are due under this key
+STAMPEDE_KEY = '__stampede_expires__'
+STAMPEDE_LOCK_TIMEOUT = 10
+STAMPEDE_WAIT = 1.0
+STAMPEDE_GRACE = 60
+STAMPEDE_POLL_INTERVAL = 0.05
+
+# Django creates one backend instance per thread: the local caches and the
+# get_or_set counters are kept here by location, so invalidations and stats
+# are seen by every instance of the process
+_local_caches = {}
+_stampede_stats = {}
+_shared_lock = Lock()
+
+
+def _shared_local_cache(location, options):
+    with _shared_lock:
+        cache = _local_caches.get(location)
+        if cache is None:
+            cache = _local_caches[location] = LocalCache(**options)
+        return cache
+
+
+def _shared_stampede_stats(location):
+    with _shared_lock:
+        return _stampede_stats.setdefault(location, {})
+
+
+def _is_entry(value):
+    return isinstance(value, dict) and STAMPEDE_KEY in value
+
+
+def _unwrap(value):
+    if _is_entry(value):
+        return value['value']
+    return value
+
 class CouchbaseCache(BaseMemcachedCache):
     def __init__(self, server, params, username=None, password=None):
         import os
@@ -55,6 +134,15 @@ class CouchbaseCache(BaseMemcachedCache):
         self._bucket = ''
         super(CouchbaseCache, self).__init__(self._server, params, library=Couchbase,
                                            value_not_found_exception=ValueError)
+        location = (tuple(self._servers), (self._options or {}).get('bucket', 'default'))
+        local_options = (self._options or {}).get('local_cache')
+        self._local = _shared_local_cache(location, local_options) if local_options else None
+        self._stampede_stats = _shared_stampede_stats(location)
+
+    def _get_memcache_timeout(self, timeout=DEFAULT_TIMEOUT):
+        # renamed get_backend_timeout in Django 1.7, the old name is gone
+        # since 1.9
+        return self.get_backend_timeout(timeout)
 
     @property
     def _cache(self):
@@ -64,6 +152,13 @@ class CouchbaseCache(BaseMemcachedCache):
         client = self._client
         if client:
             return client
+        if self._server and fake.is_fake(self._server[0]):
+            client = fake.from_url(self._server[0])
+            self._bucket = client.bucket
+            if self._options.get('instrument', instrumentation.enabled()):
+                client = instrumentation.InstrumentedBucket(client, self._bucket)
+            self._client = client
+            return client
         host = None
         port = 8091
         if len(self._server) > 0:
@@ -76,13 +171,21 @@ class CouchbaseCache(BaseMemcachedCache):
 
         self._couchbase_cli = self._options.get('couchbase-cli', '')
         self._bucket = self._options.get('bucket', 'default')
+        transcoder = self._options.get('transcoder', None)
+        if transcoder is None:
+            # also without compression or serializer options, so values
+            # written with them by other processes stay readable
+            transcoder = CacheTranscoder(
+                serializer=self._options.get('serializer'),
+                min_size=self._options.get('compress_min_size', DEFAULT_MIN_SIZE),
+                compression=self._options.get('compression'))
         client = self._lib.connect(  bucket= self._bucket,
                                      host=host,
                                      password=self._options.get('password', ''),
                                      port=port,
                                      timeout=self._options.get('operation_timeout', 10 ),
                                      lockmode=connection.LOCKMODE_WAIT, 
-                                     transcoder=self._options.get('transcoder', None ),
+                                     transcoder=transcoder,
                                      experimental_gevent_support=self._options.get('gevent_support', False ) )
                                      
         optFormat = self._options.get('format', '' )
@@ -97,23 +200,135 @@ class CouchbaseCache(BaseMemcachedCache):
             log.error( "Couchbase: unknown format '%s', use default format PICKLE" %(optFormat) )
         client.default_format = formatMap[ optFormat ]            
 
+        if self._options.get('instrument', instrumentation.enabled()):
+            client = instrumentation.InstrumentedBucket(client, self._bucket)
+
         self._client = client
 
         return client
 
 
     def get(self, key, default=None, version=None):
+        value = self._get_raw(self.make_key(key, version=version))
+        if value is MISSING:
+            return default
+        return _unwrap(value)
+
+    def _get_raw(self, key):
+        if self._local is not None:
+            value = self._local.get(key)
+            if value is not MISSING:
+                return value
         try:
-            rs = super(CouchbaseCache, self).get(key, default, version)
-            return rs.value
-        except Exception, e:
+            value = self._cache.get(key).value
+        except Exception as e:
             #log.error('CouchbaseError: %s' % e, exc_info=True)
-            return default
+            return MISSING
+        if value is MISSING:
+            # undecodable, see CacheTranscoder
+            return MISSING
+        if self._local is not None:
+            self._local.set(key, value)
+        return value
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None, beta=1.0):
+        """
+        Returns the cached value or stores and returns ``default`` (called if
+        callable), without letting many workers recompute the same key.
+
+        Values are stored with the time they are due and how long they took
+        to compute. They are recomputed a little early, with a probability
+        growing as that time approaches (scaled by ``beta``), and only by the
+        worker holding a short lock key; the others keep serving the value,
+        which stays stored for 'stampede_grace' seconds after it is due, or
+        wait up to 'stampede_wait' seconds when there is none.
+        """
+        made_key = self.make_key(key, version=version)
+        entry = self._get_raw(made_key)
+        if entry is MISSING:
+            entry = None
+        elif not _is_entry(entry):
+            # stored with set()
+            self._count('hits')
+            return entry
+        if entry is not None:
+            expires = entry[STAMPEDE_KEY]
+            if expires is None or time.time() - entry['delta'] * beta * math.log(1.0 - random.random()) < expires:
+                self._count('hits')
+                return entry['value']
+
+        lock_key = made_key + ':lock'
+        locked = self._lock(lock_key)
+        if not locked:
+            if entry is not None:
+                self._count('stale_hits')
+                return entry['value']
+            self._count('lock_waits')
+            deadline = time.time() + self._options.get('stampede_wait', STAMPEDE_WAIT)
+            while time.time() < deadline:
+                time.sleep(STAMPEDE_POLL_INTERVAL)
+                waited = self._get_raw(made_key)
+                if waited is not MISSING:
+                    return _unwrap(waited)
+
+        try:
+            start = time.time()
+            value = default() if callable(default) else default
+            now = time.time()
+            if timeout is DEFAULT_TIMEOUT:
+                timeout = self.default_timeout
+            expires = None if timeout is None else now + timeout
+            entry = {STAMPEDE_KEY: expires, 'delta': now - start, 'value': value}
+            grace = self._options.get('stampede_grace', STAMPEDE_GRACE)
+            self.set(key, entry, timeout=None if timeout is None else timeout + grace, version=version)
+            self._count('recomputes')
+        finally:
+            if locked:
+                try:
+                    self._cache.delete(lock_key)
+                except Exception as e:
+                    log.error('CouchbaseError: %s' % e, exc_info=True)
+        return value
+
+    def _lock(self, lock_key):
+        try:
+            self._cache.add(lock_key, 1, ttl=self._options.get('stampede_lock_timeout', STAMPEDE_LOCK_TIMEOUT))
+            return True
+        except exceptions.KeyExistsError:
+            return False
+        except Exception as e:
+            log.error('CouchbaseError: %s' % e, exc_info=True)
+            return True
+
+    def _count(self, name):
+        with _shared_lock:
+            self._stampede_stats[name] = self._stampede_stats.get(name, 0) + 1
+
+    def stampede_stats(self):
+        """
+        get_or_set counters: hits, stale_hits, lock_waits, recomputes, for
+        all the instances of this location in the process.
+        """
+        with _shared_lock:
+            return dict(self._stampede_stats)
+
+    def local_stats(self):
+        """
+        Hit/miss counters and size of the in-process cache, or None.
+        """
+        if self._local is None:
+            return None
+        return self._local.stats()
+
+    def _invalidate_local(self, keys):
+        if self._local is not None:
+            self._local.delete_many(keys)
 
 
 
     def set(self, key, value, timeout=None, version=None):
         key = self.make_key(key, version=version)
+        self._invalidate_local([key])
         cn = self._cache
         rs = None
         
@@ -126,7 +341,7 @@ class CouchbaseCache(BaseMemcachedCache):
             else:
                 rs = cn.set(key, value,
                          ttl=cacheTimeout )
-        except exceptions.KeyExistsError,e:
+        except exceptions.KeyExistsError as e:
             #pass
             #cn.replace( key, value, ttl=self._get_memcache_timeout(timeout) ) 
             log.error( str(e) )
@@ -136,7 +351,7 @@ class CouchbaseCache(BaseMemcachedCache):
             #          exc_info=True)
             if cacheTimeout >= 0:
                 rs = self._cache.add(key, value, ttl= cacheTimeout )
-        except Exception, e:
+        except Exception as e:
             log.error('CouchbaseError: %s' % e, exc_info=True)
             rs = False
 
@@ -144,6 +359,7 @@ class CouchbaseCache(BaseMemcachedCache):
 
     def add(self, key, value, timeout=None, version=None):
         key = self.make_key(key, version=version) 
+        self._invalidate_local([key])
         rs = False
         
         cacheTimeout = self._get_memcache_timeout(timeout) 
@@ -153,7 +369,7 @@ class CouchbaseCache(BaseMemcachedCache):
                 rs = self._cache.add(key, value, ttl=cacheTimeout )
         except exceptions.KeyExistsError:
             log.error( 'CouchbaseError: try add exist key "%s"' % key, exc_info=True )
-        except Exception, e:
+        except Exception as e:
             log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs
 
@@ -162,57 +378,107 @@ class CouchbaseCache(BaseMemcachedCache):
 
     def delete(self, key, version=None):
         key = self.make_key(key, version=version) 
+        self._invalidate_local([key])
         rs = False
         try:
             rs = self._cache.delete(key)
-        except Exception, e:
+        except Exception as e:
             pass
             #log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs
 
-    def incr(self, key, delta=1, version=None):
+    def incr(self, key, delta=1, version=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Adds ``delta`` to the counter in a single operation; a missing
+        counter is created with the value ``delta`` and the given timeout.
+        """
         key = self.make_key(key, version=version) 
+        self._invalidate_local([key])
         rs = False
         try:
-            rs = self._cache.incr( key, delta )
-        except exceptions.NotFoundError:
-            rs = self._cache.add( key, delta, ttl=self._get_memcache_timeout(0) )
-        except Exception, e:
+            rs = self._cache.counter( key, delta=delta, initial=delta,
+                                      ttl=self._get_memcache_timeout(timeout) ).value
+        except Exception as e:
             log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs        
 
-    def decr(self, key, delta=1, version=None):
+    def decr(self, key, delta=1, version=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Subtracts ``delta`` from the counter (not below 0) in a single
+        operation; a missing counter is created with the value 0.
+        """
         key = self.make_key(key, version=version) 
+        self._invalidate_local([key])
         rs = False
         try:
-            rs = self._cache.decr( key, delta )
-        except exceptions.NotFoundError:
-            rs = self._cache.add( key, delta, ttl=self._get_memcache_timeout(0) )
-        except Exception, e:
+            rs = self._cache.counter( key, delta=-delta, initial=0,
+                                      ttl=self._get_memcache_timeout(timeout) ).value
+        except Exception as e:
             log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs
 
-    def get_many(self, keys, version=None):
-        new_keys = map(lambda x: self.make_key(x, version=version), keys)
+    def incr_many(self, keys, delta=1, version=None, timeout=DEFAULT_TIMEOUT):
+        """
+        incr for several counters with one counter_multi. Returns a dict of
+        the new values by key; counters that failed are left out.
+        """
+        key_map = dict((self.make_key(key, version=version), key) for key in keys)
+        self._invalidate_local(key_map.keys())
         ret = {}
         try:
-            ret = self._cache.get_multi(new_keys, ttl=self._get_memcache_timeout(self.default_timeout))
-            for key, result in ret.iteritems():
-                if result.success:
-                    ret[key] = result.value
-        except exceptions.NotFoundError, e:
-            for key, result in e.all_results.iteritems():
-                if result.success:
-                    ret[key] = result.value
-        except Exception, e:
-            log.error('CouchbaseError: %s' % e, exc_info=True)
-        return ret        
+            results = self._cache.counter_multi( list(key_map), delta=delta, initial=delta,
+                                                 ttl=self._get_memcache_timeout(timeout) )
+        except exceptions.CouchbaseError as e:
+            log.error( 'CouchbaseError: %s' % e, exc_info=True )
+            results = getattr(e, 'all_results', None) or {}
+        except Exception as e:
+            log.error( 'CouchbaseError: %s' % e, exc_info=True )
+            results = {}
+        for key, result in results.items():
+            if result.success:
+                ret[key_map[key]] = result.value
+        return ret
+
+    def get_many(self, keys, version=None):
+        key_map = dict((self.make_key(key, version=version), key) for key in keys)
+        ret = {}
+        new_keys = []
+        for key in key_map:
+            value = self._local.get(key) if self._local is not None else MISSING
+            if value is MISSING:
+                new_keys.append(key)
+            else:
+                ret[key_map[key]] = _unwrap(value)
+
+        # a ttl turns the read into a get-and-touch, only wanted for
+        # sliding expiration
+        kwargs = {'quiet': True}
+        if self._options.get('sliding_expiration', False):
+            kwargs['ttl'] = self._get_memcache_timeout(self.default_timeout)
+
+        chunk_size = self._options.get('get_many_chunk_size', GET_MANY_CHUNK_SIZE)
+        for start in range(0, len(new_keys), chunk_size):
+            try:
+                results = self._cache.get_multi(new_keys[start:start + chunk_size], **kwargs)
+            except exceptions.CouchbaseError as e:
+                log.error('CouchbaseError: %s' % e, exc_info=True)
+                results = getattr(e, 'all_results', None) or {}
+            except Exception as e:
+                log.error('CouchbaseError: %s' % e, exc_info=True)
+                continue
+            for key, result in results.items():
+                if result.success and result.value is not MISSING:
+                    ret[key_map[key]] = _unwrap(result.value)
+                    if self._local is not None:
+                        self._local.set(key, result.value)
+        return ret
 
     def set_many(self, data, timeout=0, version=None):
         safe_data = {}
         for key, value in data.items():
             key = self.make_key(key, version=version)
             safe_data[key] = value
+        self._invalidate_local(safe_data.keys())
         rs = False    
         
         cacheTimeout = self._get_memcache_timeout(timeout)
@@ -222,16 +488,18 @@ class CouchbaseCache(BaseMemcachedCache):
                 rs = self._cache.delete_multi( safe_data.keys() )
             else:
                 rs = self._cache.set_multi(safe_data, ttl=cacheTimeout)
-        except Exception, e:
+        except Exception as e:
             log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs
 
     def delete_many(self, keys, version=None):
         l = lambda x: self.make_key(x, version=version)
+        keys = list(map(l, keys))
+        self._invalidate_local(keys)
         rs = False
         try:
-            rs = self._cache.delete_multi( map(l, keys) )
-        except Exception, e:
+            rs = self._cache.delete_multi( keys )
+        except Exception as e:
             log.error( 'CouchbaseError: %s' % e, exc_info=True )
         return rs
             
@@ -264,6 +532,9 @@ class CouchbaseCache(BaseMemcachedCache):
                         self._options.get( 'admin-pwd', '' ),
                         self._server[0], self._bucket ) )== 0
         '''
+        if self._local is not None:
+            self._local.clear()
+
         import urllib3
         conn = urllib3.connection_from_url(self._server[0], block=True, maxsize=100)
         endpoint = '/pools/default/buckets/%s/controller/doFlush' % self._bucket
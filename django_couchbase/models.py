@@ -1,28 +1,50 @@
 from __future__ import unicode_literals
+import datetime
+import json
 from decimal import Decimal
+from collections import OrderedDict, deque
+from copy import deepcopy
+from functools import partial
+from operator import itemgetter
+from threading import local
 
 from djangotoolbox.fields import ListField
-from six import string_types
+from six import integer_types, string_types, text_type, with_metaclass
 import logging
+import sys
 from django.utils import timezone, dateparse
+from django.utils.encoding import force_text
 from tastypie.serializers import Serializer
 
 logger = logging.getLogger(__name__)
 
 import couchbase
 from django.db import models
-from django.forms.models import model_to_dict
 from django.http import HttpResponseNotFound
 from django_cbtools import sync_gateway
 from django.db import models
+from django.db.models.base import ModelBase
 from django.utils import timezone
 from django.db.models.fields.files import FileField
-from couchbase.bucket import Bucket, NotFoundError, ValueResult
+from couchbase.bucket import NotFoundError, ValueResult
+from couchbase.exceptions import CouchbaseError, KeyExistsError, SubdocPathExistsError
+from couchbase.items import ItemOptionDict
+import couchbase.subdocument as SD
 from django_extensions.db.fields import ShortUUIDField
 from django.db.models.fields import DateTimeField, DecimalField
 #from django_cbtools.models import CouchbaseModel, CouchbaseModelError
 from django.conf import settings
 from django_couchbase.fields import ModelReferenceField, PartialReferenceField
+from django_couchbase.lazy import LazyEmbeddedList
+from django_couchbase import denormalize, identity
+from django_couchbase.connection import BucketDescriptor, get_bucket
+from django_couchbase.query import LOOKUP_SEP, CBManager
+
+if sys.version_info >= (3, 5):
+    from django_couchbase.aio import AsyncModelMixin
+else:
+    class AsyncModelMixin(object):
+        pass
 from djangotoolbox.fields import ListField, EmbeddedModelField, DictField
 
 CHANNELS_FIELD_NAME = "channels"
@@ -30,16 +52,245 @@ DOC_TYPE_FIELD_NAME = "doc_type"
 
 CHANNEL_PUBLIC = 'public'
 
+BULK_BATCH_SIZE = 1000
+
+# most paths a single sub-document lookup or mutation can take
+SUBDOC_MAX_SPECS = 16
+
+# lookups of a partial load retried when the document changes in between
+PARTIAL_LOAD_ATTEMPTS = 3
+
+# referenced objects collected by bulk_save instead of being saved one by one;
+# ``snapshot`` is set while is_dirty encodes a document without saving them
+_reference_batch = local()
+
+# stands for the id of a referenced object that was never saved, it differs
+# from every stored id
+_UNSAVED = object()
+
 # Create your models here.
 class CouchbaseModelError(Exception):
     pass
 
-class CBModel(models.Model):
+
+class CBConflictError(CouchbaseModelError):
+    """
+    The document was changed (or created) by someone else since it was
+    loaded.
+    """
+    pass
+
+
+def _decode_nested(nested_klass, obj, key, dict_payload):
+    obj.from_dict_nested(key, nested_klass, dict_payload)
+
+
+def _decode_nested_list(nested_klass, obj, key, dict_payload):
+    obj.from_dict_nested_list(key, nested_klass, dict_payload)
+
+
+def _decode_lazy_nested_list(nested_klass, obj, key, dict_payload):
+    # past the field's descriptor, whose to_python would hydrate every item
+    obj.__dict__[key] = LazyEmbeddedList(nested_klass, dict_payload[key] or [])
+
+
+def _own(value):
+    """
+    A copy of a mutable JSON value, so attributes never share containers
+    with the loaded document kept for dirty checks.
+    """
+    if isinstance(value, (list, dict)):
+        return deepcopy(value)
+    return value
+
+
+def _encode_partial_reference(links, obj, key, parent_dict):
+    obj.to_dict_partial_reference(key, parent_dict, links)
+
+
+def _decode_partial_reference(links, obj, key, dict_payload):
+    obj.from_dict_partial_reference(key, links, dict_payload)
+
+
+def _multi_results(operation, docs):
+    if not docs:
+        return {}
+    try:
+        rv = operation(docs)
+    except CouchbaseError as e:
+        rv = e.all_results
+    return dict(rv.items())
+
+
+def _cas_items(docs):
+    """
+    The set_multi argument writing ``docs`` (key -> (value, cas)) with a CAS
+    check per document, a cas of 0 writes unconditionally.
+    """
+    items = ItemOptionDict()
+    for key, (value, cas) in docs.items():
+        items.create_and_add(key, value, cas=cas)
+    return items
+
+
+def _to_simple(value):
+    """
+    Converts a field value to the JSON-ready value that tastypie's
+    to_json/from_json round trip used to produce, in a single pass.
+    """
+    if value is None or isinstance(value, (bool, float) + integer_types):
+        return value
+    if isinstance(value, string_types):
+        return text_type(value)
+    if isinstance(value, (list, tuple)):
+        return [_to_simple(item) for item in value]
+    if isinstance(value, dict):
+        # keys are sorted like json.dumps(sort_keys=True) did
+        items = [(key if isinstance(key, string_types) else json.dumps(key), _to_simple(item))
+                 for key, item in value.items()]
+        return dict(sorted(items, key=itemgetter(0)))
+    if isinstance(value, datetime.datetime):
+        if getattr(settings, 'USE_TZ', False) and timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.get_default_timezone())
+        if getattr(settings, 'TASTYPIE_DATETIME_FORMATTING', 'iso-8601') == 'iso-8601-strict':
+            value = value - datetime.timedelta(microseconds=value.microsecond)
+        return value.isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return force_text(value)
+
+
+def prefetch_references(objs, paths):
+    """
+    Loads the documents referenced by ``objs`` along ``paths`` and sets them
+    in place of their ids, like select_related/prefetch_related:
+
+        prefetch_references(orders, ['customer', 'items__product'])
+
+    A path walks ModelReferenceFields, lists of them, EmbeddedModelFields
+    and lists of embedded models, separated by ``__``. Each level costs one
+    get_many per referenced model, whatever the number of objects. Ids
+    without a document are left in place.
+    """
+    tree = OrderedDict()
+    for path in paths:
+        node = tree
+        for part in path.split(LOOKUP_SEP):
+            node = node.setdefault(part, OrderedDict())
+    _prefetch_level([obj for obj in objs if obj is not None], tree)
+    return objs
+
+
+def _reference_kind(field):
+    if isinstance(field, ModelReferenceField):
+        return 'reference', field.embedded_model
+    if isinstance(field, EmbeddedModelField):
+        return 'embedded', field.embedded_model
+    if isinstance(field, ListField):
+        if isinstance(field.item_field, ModelReferenceField):
+            return 'reference_list', field.item_field.embedded_model
+        if isinstance(field.item_field, EmbeddedModelField):
+            return 'embedded_list', field.item_field.embedded_model
+    raise CouchbaseModelError("'%s' is not a reference or embedded field" % field.name)
+
+
+def _prefetch_level(objs, tree):
+    if not objs or not tree:
+        return
+    meta = objs[0]._meta
+    kinds = OrderedDict((name, _reference_kind(meta.get_field(name))) for name in tree)
+
+    # ids to load, per referenced model, over all the fields of this level
+    wanted = OrderedDict()
+    for name, (kind, klass) in kinds.items():
+        if kind not in ('reference', 'reference_list'):
+            continue
+        ids = wanted.setdefault(klass, OrderedDict())
+        for obj in objs:
+            value = getattr(obj, name, None)
+            refs = (value or []) if kind == 'reference_list' else [value]
+            for ref in refs:
+                if ref and isinstance(ref, string_types):
+                    ids[ref] = True
+    loaded = {}
+    for klass, ids in wanted.items():
+        if ids:
+            loaded[klass] = dict((obj.id, obj) for obj in klass.get_many(list(ids)))
+
+    for name, (kind, klass) in kinds.items():
+        found = loaded.get(klass, {})
+        children = OrderedDict()
+        for obj in objs:
+            value = getattr(obj, name, None)
+            if kind == 'reference':
+                if isinstance(value, string_types):
+                    value = found.get(value, value)
+                    setattr(obj, name, value)
+                items = [value]
+            elif kind == 'reference_list':
+                items = [found.get(ref, ref) if isinstance(ref, string_types) else ref
+                         for ref in value or []]
+                setattr(obj, name, items)
+            elif kind == 'embedded':
+                items = [value]
+            else:
+                items = value or []
+            for item in items:
+                if item is not None and not isinstance(item, string_types):
+                    children[id(item)] = item
+        _prefetch_level(list(children.values()), tree[name])
+
+
+class CBModelBase(ModelBase):
+    def __new__(mcs, name, bases, attrs, **kwargs):
+        cls = super(CBModelBase, mcs).__new__(mcs, name, bases, attrs, **kwargs)
+        if hasattr(cls, '_meta'):
+            cls._compile_field_plan()
+            # abstract parents have no documents of their own, their fields
+            # are registered with every concrete subclass
+            if getattr(cls, 'bucket', None) and not cls._meta.abstract:
+                for field in cls._meta.local_fields:
+                    if isinstance(field, PartialReferenceField) and field.links and field.embedded_model:
+                        denormalize.register(cls, field)
+                _models['%s.%s' % (cls.__module__, cls.__name__)] = cls
+        return cls
+
+
+# every CBModel class stored in a bucket, by dotted path
+_models = OrderedDict()
+
+
+def get_models():
+    """
+    Returns the CBModel classes that are stored in a bucket, one per doc_type.
+    """
+    models_by_doc_type = OrderedDict()
+    for model in _models.values():
+        models_by_doc_type[model().get_doc_type()] = model
+    return list(models_by_doc_type.values())
+
+
+def get_model(name):
+    """
+    Finds a stored CBModel by class name, dotted path or doc_type.
+    """
+    for path, model in reversed(list(_models.items())):
+        if name in (path, model.__name__, model().get_doc_type()):
+            return model
+    raise LookupError("no CBModel named '%s'" % name)
+
+
+class CBModel(with_metaclass(CBModelBase, AsyncModelMixin, models.Model)):
     class Meta:
         abstract = True
 
     id_prefix = 'st'
     doc_type = None
+    # True, or the names of the ListField(EmbeddedModelField) fields whose
+    # items are only hydrated on access, see django_couchbase.lazy
+    lazy_embedded_lists = False
+    db = BucketDescriptor()
+    objects = CBManager()
     _serializer = Serializer()
 
     def __eq__(self, other):
@@ -50,8 +301,10 @@ class CBModel(models.Model):
         self.channels = []
         self.id = None
         self.rev = None
-        if hasattr(self, 'bucket'):
-            self.db = self.get_bucket()
+        # the document as last loaded or saved, to skip saving unchanged ones
+        self._loaded_state = None
+        # set on instances loaded with only some of their fields
+        self._partial_fields = None
         if 'id_prefix' in kwargs:
             self.id_prefix = kwargs['id_prefix']
             del kwargs['id_prefix']
@@ -79,14 +332,120 @@ class CBModel(models.Model):
         return self.id
 
     def get_bucket(self):
-        return Bucket(''.join(['couchbase://', settings.CB_BUCKETS.get(self.bucket)]))
+        return get_bucket(self.bucket)
 
     def save(self, *args, **kwargs):
+        if self._partial_fields is not None and kwargs.get('allow_partial'):
+            return self._save_partial()
+        is_new, data_dict = self._prepare_document()
+        if data_dict is None:
+            return
+        try:
+            if is_new:
+                rv = self.db.add(self.get_id(), data_dict)
+            else:
+                rv = self.db.set(self.get_id(), data_dict, cas=self.rev or 0)
+        except KeyExistsError:
+            self._conflict()
+        self._saved(data_dict, rv.cas, is_new)
+
+    def _save_partial(self):
+        """
+        Writes the loaded fields of a partial object that changed, with one
+        sub-document mutation per SUBDOC_MAX_SPECS fields. Every mutation is
+        checked against the CAS left by the previous one, so a concurrent
+        write raises CBConflictError (the chunks written before stay).
+        """
+        data_dict = self.to_dict()
+        loaded = self._loaded_state or {}
+        changed = [name for name in sorted(self._partial_fields)
+                   if name in data_dict and data_dict[name] != loaded.get(name)]
+        if not changed:
+            return
         self.updated = timezone.now()
-        if not hasattr(self, 'created') or self.created is None:
-            self.created = self.updated
+        self._encode_fields(data_dict, ('updated',))
+        if 'updated' in data_dict:
+            changed.append('updated')
+        cas = self.rev or 0
+        for start in range(0, len(changed), SUBDOC_MAX_SPECS):
+            specs = [SD.upsert(name, data_dict[name]) for name in changed[start:start + SUBDOC_MAX_SPECS]]
+            try:
+                cas = self.db.mutate_in(self.id, *specs, cas=cas).cas
+            except KeyExistsError:
+                self._conflict()
+        self.rev = cas
+        self._loaded_state = dict(loaded)
+        for name in changed:
+            self._loaded_state[name] = data_dict[name]
+        denormalize.propagate(self, loaded, self._loaded_state)
+
+    def save_with_retry(self, mutator, max_attempts=3):
+        """
+        Applies ``mutator(self)`` and saves; when someone else changed the
+        document in between, reloads it and tries again, up to
+        ``max_attempts`` times.
+        """
+        for attempt in range(max_attempts):
+            mutator(self)
+            try:
+                self.save()
+                return self
+            except CBConflictError:
+                if attempt == max_attempts - 1:
+                    raise
+                self.from_row(self.db.get(self.id))
+
+    def _conflict(self):
+        identity_map = identity.current()
+        if identity_map is not None:
+            identity_map.discard(self)
+        raise CBConflictError('%s was changed since it was loaded' % self.id)
+
+    def _prepare_document(self):
+        """
+        Returns (is_new, document to write), the document is None if nothing
+        changed since the object was loaded or last saved.
+        """
+        if self._partial_fields is not None:
+            raise CouchbaseModelError('this object was loaded with only some of its fields, '
+                                      'use save(allow_partial=True)')
+        is_new = self.is_new()
+        self._save_files()
+        data_dict = self.to_dict()
+        if not is_new and data_dict == self._loaded_state:
+            return is_new, None
+        self._touch(data_dict)
+        return is_new, data_dict
+
+    def _saved(self, data_dict, cas=None, is_new=False):
+        if not is_new:
+            # nothing references a document that was just added
+            denormalize.propagate(self, self._loaded_state, data_dict)
+        self._loaded_state = data_dict
+        self.rev = cas
+        identity_map = identity.current()
+        if identity_map is not None:
+            identity_map.add(self, replace=True)
+
+    def is_dirty(self):
+        """
+        True if the document differs from what was last loaded or saved.
+        """
+        return self.is_new() or self._snapshot() != self._loaded_state
+
+    def _snapshot(self):
+        """
+        to_dict without side effects: referenced objects are neither saved
+        nor given ids.
+        """
+        outer = getattr(_reference_batch, 'snapshot', False)
+        _reference_batch.snapshot = True
+        try:
+            return self.to_dict()
+        finally:
+            _reference_batch.snapshot = outer
 
-        # save files
+    def _save_files(self):
         for field in self._meta.fields:
             if isinstance(field, FileField):
                 file_field = getattr(self, field.name)
@@ -94,73 +453,321 @@ class CBModel(models.Model):
                 if not file_field._committed:
                     file_field.save(file_field.name, file_field, False)
 
-        data_dict = self.to_dict()
-        if self.is_new():
-            self.db.add(self.get_id(), data_dict)
+    def _touch(self, data_dict):
+        self.updated = timezone.now()
+        if not hasattr(self, 'created') or self.created is None:
+            self.created = self.updated
+        self._encode_fields(data_dict, ('created', 'updated'))
+
+    def _encode_fields(self, data_dict, names):
+        for name, attname in self._plain_fields:
+            if attname is not None and name in names:
+                data_dict[name] = _to_simple(getattr(self, attname))
+        for name, encode in self._field_encoders:
+            if name in names:
+                encode(self, name, data_dict)
+
+    @classmethod
+    def bulk_save(cls, objs, batch_size=BULK_BATCH_SIZE):
+        """
+        Saves ``objs`` with one add_multi (new documents) and one set_multi
+        (existing documents) per bucket and batch of ``batch_size``. Existing
+        documents are written with their ``rev`` as CAS like save() does.
+
+        Referenced objects that would be saved one by one from to_dict are
+        queued into the following batches instead. Unchanged documents are
+        skipped. Returns a dict mapping every written document id to True on
+        success and False on failure, a document changed by someone else
+        since it was loaded is a failure and is left as it is in the bucket.
+        """
+        results = {}
+        queue = deque(objs)
+        queued = set(id(obj) for obj in queue)
+        while queue:
+            batch = [queue.popleft() for _ in range(min(batch_size, len(queue)))]
+            groups = {}
+            written = {}
+            references = []
+            outer = getattr(_reference_batch, 'pending', None)
+            _reference_batch.pending = references
+            try:
+                for obj in batch:
+                    is_new, data_dict = obj._prepare_document()
+                    if data_dict is None:
+                        continue
+                    new, existing = groups.setdefault(obj.bucket, ({}, {}))
+                    if is_new:
+                        new[obj.get_id()] = data_dict
+                    else:
+                        existing[obj.get_id()] = (data_dict, obj.rev or 0)
+                    written[obj.get_id()] = (obj, data_dict, is_new)
+            finally:
+                _reference_batch.pending = outer
+
+            for obj in references:
+                if id(obj) not in queued:
+                    queued.add(id(obj))
+                    queue.append(obj)
+
+            batch_results = {}
+            for alias, (new, existing) in groups.items():
+                db = get_bucket(alias)
+                batch_results.update(_multi_results(db.add_multi, new))
+                batch_results.update(_multi_results(lambda docs: db.set_multi(_cas_items(docs)), existing))
+            for key, result in batch_results.items():
+                if result.success:
+                    obj, data_dict, is_new = written[key]
+                    obj._saved(data_dict, result.cas, is_new)
+                results[key] = result.success
+        return results
+
+    def _reference_id(self, obj):
+        """
+        Saves the referenced ``obj`` (or queues it, see bulk_save) and
+        returns its id.
+        """
+        if getattr(_reference_batch, 'snapshot', False):
+            return _UNSAVED if obj.is_new() else obj.id
+        self._save_reference(obj)
+        return obj.get_id()
+
+    def _save_reference(self, obj):
+        pending = getattr(_reference_batch, 'pending', None)
+        if pending is None:
+            obj.save()
         else:
-            self.db.set(self.get_id(), data_dict)
-
+            pending.append(obj)
 
     # for saving
     def to_dict(self):
-        d = model_to_dict(self)
-        tastyjson = self._serializer.to_json(d)
-        d = self._serializer.from_json(tastyjson)
+        d = {}
+        for name, attname in self._plain_fields:
+            d[name] = None if attname is None else _to_simple(getattr(self, attname))
 
         d[DOC_TYPE_FIELD_NAME] = self.get_doc_type()
-        d['id'] = self.get_id()
+        d['id'] = self.id if getattr(_reference_batch, 'snapshot', False) else self.get_id()
         if 'cbnosync_ptr' in d: del d['cbnosync_ptr']
         if 'csrfmiddlewaretoken' in d: del d['csrfmiddlewaretoken']
-        for field in self._meta.fields:
-            if isinstance(field, DateTimeField):
-                d[field.name] = self._string_from_date(field.name)
-            if isinstance(field, ListField):
-                if isinstance(field.item_field, EmbeddedModelField):
-                    self.to_dict_nested_list(field.name, d)
-                if isinstance(field.item_field, ModelReferenceField):
-                    self.to_dict_reference_list(field.name, d)
-            if isinstance(field, EmbeddedModelField):
-                self.to_dict_nested(field.name, d)
-            if isinstance(field, ModelReferenceField):
-                self.to_dict_reference(field.name, d)
+        for name, encode in self._field_encoders:
+            encode(self, name, d)
         return d
 
     def from_dict(self, dict_payload):
-        for field in self._meta.fields:
-            if field.name not in dict_payload:
+        for name, decode in self._field_decoders:
+            if name in dict_payload:
+                decode(self, name, dict_payload)
+        if 'id' in dict_payload:
+            self.id = dict_payload['id']
+
+    @classmethod
+    def _compile_field_plan(cls):
+        """
+        Resolves every field to the callables that encode and decode it, so
+        that to_dict and from_dict do not introspect fields on each call.
+        """
+        encoders = []
+        decoders = []
+        # fields whose encoder always writes the key only get a placeholder
+        # (attname None), which keeps the key order of documents written by
+        # earlier versions (model_to_dict -> sorted JSON -> dict)
+        plain = []
+        for field in sorted(cls._meta.fields, key=lambda f: f.name):
+            if not field.editable:
                 continue
+            if isinstance(field, (EmbeddedModelField, DateTimeField, PartialReferenceField)) or (
+                    isinstance(field, ListField) and
+                    isinstance(field.item_field, (EmbeddedModelField, ModelReferenceField))):
+                plain.append((field.name, None))
+            else:
+                plain.append((field.name, field.attname))
+
+        for field in cls._meta.fields:
+            name = field.name
             if isinstance(field, EmbeddedModelField):
-                self.from_dict_nested(field.name, field.embedded_model, dict_payload)
-                continue
-            if isinstance(field, ListField):
+                encoders.append((name, cls.to_dict_nested))
+                decoders.append((name, partial(_decode_nested, field.embedded_model)))
+            elif isinstance(field, ListField):
                 if isinstance(field.item_field, EmbeddedModelField):
-                    self.from_dict_nested_list(field.name, field.item_field.embedded_model, dict_payload)
-                continue
-            if isinstance(field, DateTimeField):
-                self._date_from_string(field.name, dict_payload.get(field.name))
+                    encoders.append((name, cls.to_dict_nested_list))
+                    lazy = cls.lazy_embedded_lists
+                    decode = _decode_nested_list
+                    if lazy is True or (lazy and name in lazy):
+                        decode = _decode_lazy_nested_list
+                    decoders.append((name, partial(decode, field.item_field.embedded_model)))
+                elif isinstance(field.item_field, ModelReferenceField):
+                    encoders.append((name, cls.to_dict_reference_list))
+                    decoders.append((name, cls.from_dict_value))
+                else:
+                    decoders.append((name, cls.from_dict_value))
+            elif isinstance(field, ModelReferenceField):
+                encoders.append((name, cls.to_dict_reference))
+                decoders.append((name, cls.from_dict_value))
+            elif isinstance(field, PartialReferenceField):
+                encoders.append((name, partial(_encode_partial_reference, field.links)))
+                decoders.append((name, partial(_decode_partial_reference, field.links)))
+            elif isinstance(field, DateTimeField):
+                encoders.append((name, cls.to_dict_date))
+                decoders.append((name, cls.from_dict_date))
             elif isinstance(field, DecimalField):
-                self._decimal_from_string(field.name, dict_payload.get(field.name))
-            elif field.name in dict_payload:
-                setattr(self, field.name, dict_payload[field.name])
-        if 'id' in dict_payload.keys():
-            self.id = dict_payload['id']
-
-
+                decoders.append((name, cls.from_dict_decimal))
+            else:
+                decoders.append((name, cls.from_dict_value))
+        cls._plain_fields = tuple(plain)
+        cls._field_encoders = tuple(encoders)
+        cls._field_decoders = tuple(decoders)
 
     def from_row(self, row):
-        self.from_dict(row.value)
-        self.id = row.key
+        self._hydrate(row.key, row.value, row.cas)
+
+    def _hydrate(self, key, value, cas=None):
+        self.from_dict(value)
+        self.id = key
+        self.rev = cas
+        # the decoders copy the containers they keep, so ``value`` is not
+        # changed through the attributes; _loaded_state is only ever
+        # replaced, which lets identity map hits share it
+        self._loaded_state = value
 
     def load(self, id):
+        identity_map = identity.current()
+        cached = identity_map.get(type(self), id) if identity_map is not None else None
+        if cached is not None and cached._loaded_state is not None:
+            self._hydrate(cached.id, cached._loaded_state, cached.rev)
+            return
         try:
             doc = self.db.get(id)
             self.from_row(doc)
         except:
             raise NotFoundError
+        if identity_map is not None:
+            identity_map.add(self)
+
+    @classmethod
+    def get(cls, id):
+        return cls.get_many([id], missing='raise')[0]
 
     def load_list(self, doc):
         self.from_row(doc)
 
+    @classmethod
+    def get_many(cls, ids, missing='skip', batch_size=None, fields=None, prefetch=None):
+        """
+        Loads the documents ``ids`` with get_multi (one call per
+        ``batch_size`` ids) and returns the hydrated models in input order.
+
+        ``missing`` decides what happens to ids without a document: 'skip'
+        leaves them out, 'none' puts None in their place and 'raise' raises
+        NotFoundError.
+
+        With ``fields`` only those fields are fetched (one N1QL query with
+        USE KEYS per batch) and partial objects are returned, see
+        load_fields.
+
+        ``prefetch`` lists reference paths to load as well, see
+        prefetch_references.
+        """
+        ids, hydrated, fetch_ids = cls._lookup_many(ids, missing)
+        step = batch_size or len(fetch_ids) or 1
+        if fields is not None:
+            partial = {}
+            for start in range(0, len(fetch_ids), step):
+                query = cls.objects.only(*fields).use_keys(fetch_ids[start:start + step])
+                partial.update((obj.id, obj) for obj in query)
+            partial.update(hydrated)
+            objs = cls._collect(ids, partial, missing)
+        else:
+            rows = {}
+            if fetch_ids:
+                db = cls.db
+                for start in range(0, len(fetch_ids), step):
+                    rows.update(db.get_multi(fetch_ids[start:start + step], quiet=True))
+            objs = cls._hydrate_many(ids, hydrated, rows, missing)
+        if prefetch:
+            prefetch_references(objs, prefetch)
+        return objs
+
+    @classmethod
+    def load_fields(cls, id, fields):
+        """
+        Loads only ``fields`` of the document ``id`` with a sub-document
+        lookup. The returned object refuses save() unless it is called with
+        allow_partial=True, which then writes only these fields.
+
+        More than SUBDOC_MAX_SPECS fields take several lookups; they are
+        retried when the document changed between them, and CBConflictError
+        is raised if it keeps changing.
+        """
+        db = cls.db
+        fields = list(fields)
+        for attempt in range(PARTIAL_LOAD_ATTEMPTS):
+            payload = {}
+            cas = None
+            consistent = True
+            for start in range(0, len(fields), SUBDOC_MAX_SPECS):
+                chunk = fields[start:start + SUBDOC_MAX_SPECS]
+                rv = db.lookup_in(id, *[SD.get(name) for name in chunk])
+                if cas is not None and rv.cas != cas:
+                    consistent = False
+                    break
+                cas = rv.cas
+                for name in chunk:
+                    if rv.exists(name):
+                        payload[name] = rv[name]
+            if consistent:
+                break
+        else:
+            raise CBConflictError('%s kept changing while its fields were loaded' % id)
+        obj = cls()
+        obj._hydrate(id, payload, cas)
+        obj._partial_fields = frozenset(fields)
+        return obj
+
+    @classmethod
+    def _lookup_many(cls, ids, missing):
+        """
+        Returns the ids as a list, the objects already in the identity map
+        by id and the unique ids that still have to be fetched.
+        """
+        if missing not in ('skip', 'none', 'raise'):
+            raise ValueError("missing must be 'skip', 'none' or 'raise'")
+        ids = list(ids)
+        hydrated = {}
+        identity_map = identity.current()
+        if identity_map is not None:
+            for id in ids:
+                obj = identity_map.get(cls, id)
+                if obj is not None:
+                    hydrated[id] = obj
+        fetch_ids = [id for id in OrderedDict.fromkeys(ids) if id not in hydrated]
+        return ids, hydrated, fetch_ids
+
+    @classmethod
+    def _hydrate_many(cls, ids, hydrated, rows, missing):
+        identity_map = identity.current()
+        for id, row in rows.items():
+            if id in hydrated or not row.success:
+                continue
+            obj = cls()
+            obj.from_row(row)
+            if identity_map is not None:
+                obj = identity_map.add(obj)
+            hydrated[id] = obj
+        return cls._collect(ids, hydrated, missing)
+
+    @classmethod
+    def _collect(cls, ids, objs_by_id, missing):
+        objs = []
+        for id in ids:
+            obj = objs_by_id.get(id)
+            if obj is None:
+                if missing == 'raise':
+                    raise NotFoundError('document %s not found' % id)
+                if missing == 'none':
+                    objs.append(None)
+                continue
+            objs.append(obj)
+        return objs
+
     def delete(self):
         try:
             for field in self._meta.fields:
@@ -171,37 +778,47 @@ class CBModel(models.Model):
                     # TODO delete after load related and check on delete
                     # field.embedded_model.db.remove(getattr(self,field.name))
             self.db.remove(self.id)
+            identity_map = identity.current()
+            if identity_map is not None:
+                identity_map.discard(self)
         except NotFoundError:
             return HttpResponseNotFound
 
     def load_related(self,related_attr, related_klass):
         id = getattr(self, related_attr)
-        return related_klass(id)
+        if isinstance(id, related_klass):
+            # prefetched
+            return id
+        if not id:
+            # unset reference, an empty object as before
+            return related_klass()
+        return related_klass.get(id)
 
     def load_related_list(self,related_attr, related_klass):
-        ids = getattr(self, related_attr)
-        docs_arr = related_klass.db.get_multi(ids)
-        objs = []
-        for doc in docs_arr:
-            value = docs_arr[doc]
-            objs.append(related_klass(value))
-        return objs
+        refs = getattr(self, related_attr) or []
+        if all(isinstance(ref, related_klass) for ref in refs):
+            return list(refs)
+        ids = [ref if isinstance(ref, string_types) else ref.get_id() for ref in refs]
+        return related_klass.get_many(ids, missing='raise')
 
     def to_dict_nested(self, key, parent_dict):
         parent_dict[key] = getattr(self, key).to_dict()
         return parent_dict
 
     def to_dict_nested_list(self, key, parent_dict):
+        items = getattr(self, key)
+        if isinstance(items, LazyEmbeddedList):
+            parent_dict[key] = items.to_dicts()
+            return parent_dict
         parent_dict[key] = []
-        for item in getattr(self, key):
+        for item in items:
             parent_dict[key].append(item.to_dict())
         return parent_dict
 
     def to_dict_reference(self, key, parent_dict):
         ref_obj = getattr(self,key)
         if ref_obj and not isinstance(ref_obj, string_types):
-            ref_obj.save()
-            parent_dict[key] = ref_obj.id
+            parent_dict[key] = self._reference_id(ref_obj)
         return parent_dict
 
     def to_dict_reference_list(self, key, parent_dict):
@@ -210,21 +827,43 @@ class CBModel(models.Model):
         if isinstance(ref_objs, list) and len(ref_objs):
             for obj in ref_objs:
                 if obj and not isinstance(obj, string_types):
-                    obj.save()
-                    id_arr.append(obj.id)
+                    id_arr.append(self._reference_id(obj))
+                elif obj:
+                    id_arr.append(obj)
         parent_dict[key] =  id_arr
         return parent_dict
 
     def to_dict_partial_reference(self, key, parent_dict,links):
         ref_obj = getattr(self, key)
         if ref_obj and not isinstance(ref_obj, string_types):
-            ref_obj.save()
-            parent_dict[key] = ref_obj.id
-            for key,value in links.iteritems():
-                parent_dict[key] = getattr(ref_obj,value)
-                pass
+            parent_dict[key] = self._reference_id(ref_obj)
+            for link, attr in links.items():
+                parent_dict[link] = _to_simple(getattr(ref_obj, attr))
+        elif ref_obj:
+            # only the id is known, keep the copies as they were loaded
+            parent_dict[key] = ref_obj
+            for link in links:
+                parent_dict[link] = _to_simple(getattr(self, link, None))
+        return parent_dict
+
+    def from_dict_partial_reference(self, key, links, dict_payload):
+        setattr(self, key, dict_payload[key])
+        for link in links:
+            setattr(self, link, _own(dict_payload.get(link)))
+
+    def to_dict_date(self, key, parent_dict):
+        parent_dict[key] = self._string_from_date(key)
         return parent_dict
 
+    def from_dict_value(self, key, dict_payload):
+        setattr(self, key, _own(dict_payload[key]))
+
+    def from_dict_date(self, key, dict_payload):
+        self._date_from_string(key, dict_payload.get(key))
+
+    def from_dict_decimal(self, key, dict_payload):
+        self._decimal_from_string(key, dict_payload.get(key))
+
     def from_dict_nested(self, key, nested_klass, dict_payload):
         if key in dict_payload.keys():
             item = nested_klass()
@@ -271,6 +910,56 @@ class CBModel(models.Model):
 
         setattr(self, key, v)
 
+    def append_to_stored_references_list(self, key, value):
+        """
+        Adds ``value`` to the list ``key`` of the stored document with one
+        sub-document array_addunique, without rewriting the document, and
+        reflects the change on this object.
+
+        The mutation is checked against the CAS of this object, if it has
+        one, so CBConflictError is raised when the document changed since it
+        was loaded.
+        """
+        try:
+            rv = self.db.mutate_in(self.id, SD.array_addunique(key, value, create_parents=True),
+                                   cas=self.rev or 0)
+        except KeyExistsError:
+            self._conflict()
+        except SubdocPathExistsError:
+            rv = None
+        self.append_to_references_list(key, value)
+        self._stored_list_changed(key, rv.cas if rv is not None else None)
+
+    def delete_from_stored_references_list(self, key, value):
+        """
+        Removes ``value`` from the list ``key`` of the stored document with a
+        sub-document remove of its index, without rewriting the document,
+        and reflects the change on this object.
+
+        The removal is checked against the CAS of this object, or of the
+        lookup that found the index, so CBConflictError is raised when the
+        document changed in between.
+        """
+        rv = self.db.lookup_in(self.id, SD.get(key))
+        if self.rev and rv.cas != self.rev:
+            self._conflict()
+        stored = (rv[key] if rv.exists(key) else None) or []
+        if value in stored:
+            try:
+                rv = self.db.mutate_in(self.id, SD.remove('%s[%d]' % (key, stored.index(value))),
+                                       cas=rv.cas)
+            except KeyExistsError:
+                self._conflict()
+        self.delete_from_references_list(key, value)
+        self._stored_list_changed(key, rv.cas)
+
+    def _stored_list_changed(self, key, cas):
+        if cas is not None:
+            self.rev = cas
+        if self._loaded_state is not None:
+            self._loaded_state = dict(self._loaded_state)
+            self._loaded_state[key] = list(self.get_references_list(key))
+
     def is_new(self):
         return not hasattr(self, 'id') or not self.id
 
@@ -0,0 +1,349 @@
+"""
+N1QL queries over the documents of one CBModel doc type.
+
+    Book.objects.filter(pages__gte=100).exclude(publisher=None).order_by('-created')[:20]
+    Book.objects.filter(name__startswith='First').values_list('name', flat=True)
+
+Every query is scoped to ``doc_type = Model.get_doc_type()``. Results are
+streamed from the server row by row and are not cached, so iterating a
+queryset twice runs the query twice.
+
+Field paths use ``__`` for nested attributes (``blog__url``), the last part
+can be a lookup: exact, ne, gt, gte, lt, lte, in, contains, icontains,
+startswith, isnull.
+"""
+import copy
+import json
+
+from django.db.models.manager import BaseManager, ManagerDescriptor
+
+from django_couchbase.connection import bucket_name
+
+LOOKUP_SEP = '__'
+
+OPERATORS = {
+    'exact': '%s = %s',
+    'ne': '%s != %s',
+    'gt': '%s > %s',
+    'gte': '%s >= %s',
+    'lt': '%s < %s',
+    'lte': '%s <= %s',
+    'in': '%s IN %s',
+    'contains': 'CONTAINS(%s, %s)',
+    'icontains': 'CONTAINS(LOWER(%s), LOWER(%s))',
+    'startswith': '%s LIKE %s',
+}
+
+LOOKUPS = set(OPERATORS) | {'isnull'}
+
+ALIAS = 'd'
+
+
+def quote(name):
+    return '`%s`' % name.replace('`', '``')
+
+
+def field_path(name):
+    return '.'.join([ALIAS] + [quote(part) for part in name.split(LOOKUP_SEP)])
+
+
+def doc_type_condition(model, path=None):
+    """
+    ``d.`doc_type` = "book"`` for ``model``. The doc type is inlined rather
+    than passed as a parameter so that the planner can match the partial
+    indexes (``WHERE `doc_type` = "book"``) created by cb_indexes.
+    """
+    from django_couchbase.models import DOC_TYPE_FIELD_NAME
+    return '%s = %s' % (path or field_path(DOC_TYPE_FIELD_NAME), json.dumps(model().get_doc_type()))
+
+
+def _simple(value):
+    from django_couchbase.models import _to_simple
+    return _to_simple(value)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def n1ql_executor(model):
+    """
+    Runs statements with the SDK's streaming n1ql_query on the model bucket.
+    """
+    def execute(statement, params):
+        from couchbase.n1ql import N1QLQuery
+        return model.db.n1ql_query(N1QLQuery(statement, *params))
+    return execute
+
+
+class CBQuerySet(object):
+    """
+    Lazily built N1QL query. ``executor`` is any callable taking a statement
+    and its positional parameters and returning an iterable of row dicts.
+    """
+
+    def __init__(self, model, executor=None):
+        self.model = model
+        self.executor = executor
+        self._where = []
+        self._order_by = []
+        self._limit = None
+        self._offset = None
+        self._only = None
+        self._values = None
+        self._values_mode = None
+        self._keys = None
+        self._prefetch = ()
+
+    def _clone(self):
+        qs = self.__class__(self.model, self.executor)
+        qs.__dict__.update(self.__dict__)
+        qs._where = list(self._where)
+        qs._order_by = list(self._order_by)
+        return qs
+
+    def all(self):
+        return self._clone()
+
+    def with_executor(self, executor):
+        qs = self._clone()
+        qs.executor = executor
+        return qs
+
+    def filter(self, **kwargs):
+        qs = self._clone()
+        qs._where.append((False, sorted(kwargs.items())))
+        return qs
+
+    def exclude(self, **kwargs):
+        qs = self._clone()
+        qs._where.append((True, sorted(kwargs.items())))
+        return qs
+
+    def order_by(self, *fields):
+        qs = self._clone()
+        qs._order_by = list(fields)
+        return qs
+
+    def limit(self, count):
+        qs = self._clone()
+        qs._limit = count
+        return qs
+
+    def offset(self, count):
+        qs = self._clone()
+        qs._offset = count
+        return qs
+
+    def use_keys(self, ids):
+        qs = self._clone()
+        qs._keys = list(ids)
+        return qs
+
+    def only(self, *fields):
+        qs = self._clone()
+        qs._only = list(fields)
+        return qs
+
+    def prefetch(self, *paths):
+        """
+        Loads the documents referenced along ``paths`` for the whole result,
+        see models.prefetch_references.
+        """
+        qs = self._clone()
+        qs._prefetch = self._prefetch + paths
+        return qs
+
+    def values(self, *fields):
+        qs = self._clone()
+        qs._values = list(fields)
+        qs._values_mode = 'dict'
+        return qs
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid with a single field")
+        qs = self._clone()
+        qs._values = list(fields)
+        qs._values_mode = 'flat' if flat else 'tuple'
+        return qs
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError('slice steps are not supported')
+            qs = self._clone()
+            start = k.start or 0
+            if start:
+                qs._offset = (self._offset or 0) + start
+            if k.stop is not None:
+                qs._limit = k.stop - start
+            return qs
+        for obj in self[k:k + 1]:
+            return obj
+        raise IndexError('queryset index out of range')
+
+    def __iter__(self):
+        return self.iterator()
+
+    def _conditions(self, lookups, params):
+        sql = []
+        for key, value in lookups:
+            parts = key.split(LOOKUP_SEP)
+            lookup = 'exact'
+            if len(parts) > 1 and parts[-1] in LOOKUPS:
+                lookup = parts.pop()
+            path = field_path(LOOKUP_SEP.join(parts))
+            if lookup == 'isnull' or (lookup == 'exact' and value is None):
+                null = value if lookup == 'isnull' else True
+                sql.append('%s IS %s' % (path, 'NOT VALUED' if null else 'VALUED'))
+                continue
+            if lookup == 'in':
+                value = [_simple(v) for v in value]
+            elif lookup == 'startswith':
+                value = _escape_like(value) + '%'
+            else:
+                value = _simple(value)
+            params.append(value)
+            sql.append(OPERATORS[lookup] % (path, '$%d' % len(params)))
+        return ' AND '.join(sql) or 'TRUE'
+
+    def _from_where(self, params):
+        clause = ' FROM %s %s' % (quote(bucket_name(self.model.bucket)), ALIAS)
+        if self._keys is not None:
+            params.append(self._keys)
+            clause += ' USE KEYS $%d' % len(params)
+        where = [doc_type_condition(self.model)]
+        for negated, lookups in self._where:
+            sql = self._conditions(lookups, params)
+            where.append(('NOT (%s)' if negated else '(%s)') % sql)
+        return clause + ' WHERE ' + ' AND '.join(where)
+
+    def _select(self):
+        meta_id = 'META(%s).id AS `__id`' % ALIAS
+        if self._values is not None:
+            if not self._values:
+                return '%s, %s.*' % (meta_id, ALIAS)
+            return ', '.join([meta_id] + ['%s AS %s' % (field_path(f), quote(f)) for f in self._values])
+        meta_id += ', META(%s).cas AS `__cas`' % ALIAS
+        if self._only is not None:
+            doc = ', '.join('"%s": %s' % (f, field_path(f)) for f in self._only)
+            return '%s, {%s} AS `__doc`' % (meta_id, doc)
+        return '%s, %s AS `__doc`' % (meta_id, ALIAS)
+
+    def statement(self):
+        """
+        Returns the N1QL statement and its positional parameters.
+        """
+        params = []
+        statement = 'SELECT ' + self._select() + self._from_where(params)
+        if self._order_by:
+            order = []
+            for name in self._order_by:
+                if name.startswith('-'):
+                    order.append(field_path(name[1:]) + ' DESC')
+                else:
+                    order.append(field_path(name) + ' ASC')
+            statement += ' ORDER BY ' + ', '.join(order)
+        if self._limit is not None:
+            statement += ' LIMIT %d' % self._limit
+        if self._offset:
+            statement += ' OFFSET %d' % self._offset
+        return statement, params
+
+    def execute(self, statement, params):
+        executor = self.executor or n1ql_executor(self.model)
+        return executor(statement, params)
+
+    def iterator(self):
+        statement, params = self.statement()
+        rows = self.execute(statement, params)
+        if self._values is not None:
+            fields = self._values
+            for row in rows:
+                if self._values_mode == 'dict':
+                    d = dict(row)
+                    d['id'] = d.pop('__id')
+                    yield d
+                elif self._values_mode == 'flat':
+                    yield row.get(fields[0])
+                else:
+                    yield tuple(row.get(f) for f in fields)
+            return
+
+        objs = self._objects(rows)
+        if self._prefetch:
+            from django_couchbase.models import prefetch_references
+            objs = prefetch_references(list(objs), self._prefetch)
+        for obj in objs:
+            yield obj
+
+    def _objects(self, rows):
+        for row in rows:
+            obj = self.model()
+            obj._hydrate(row['__id'], row['__doc'], row.get('__cas'))
+            if self._only is not None:
+                obj._partial_fields = frozenset(self._only)
+            yield obj
+
+    def count(self):
+        params = []
+        statement = 'SELECT COUNT(*) AS `count`' + self._from_where(params)
+        for row in self.execute(statement, params):
+            return row['count']
+        return 0
+
+    def exists(self):
+        for _ in self.values('id')[:1]:
+            return True
+        return False
+
+    def first(self):
+        for obj in self[:1]:
+            return obj
+        return None
+
+    def get(self, **kwargs):
+        objs = list(self.filter(**kwargs)[:2])
+        if not objs:
+            from couchbase.exceptions import NotFoundError
+            raise NotFoundError('%s matching query does not exist' % self.model.__name__)
+        if len(objs) > 1:
+            from django_couchbase.models import CouchbaseModelError
+            raise CouchbaseModelError('get() returned more than one %s' % self.model.__name__)
+        return objs[0]
+
+
+class CBManager(BaseManager.from_queryset(CBQuerySet)):
+    """
+    ``Model.objects``: hands out a fresh CBQuerySet for the model class.
+
+    A real Manager, so Django keeps it on concrete subclasses instead of
+    adding its own ``objects``.
+    """
+
+    def __init__(self, executor=None):
+        super(CBManager, self).__init__()
+        self.executor = executor
+
+    def get_queryset(self):
+        return CBQuerySet(self.model, self.executor)
+
+    def contribute_to_class(self, model, name):
+        super(CBManager, self).contribute_to_class(model, name)
+        setattr(model, name, CBManagerDescriptor(self))
+
+
+class CBManagerDescriptor(ManagerDescriptor):
+    """
+    Like Django's, but abstract models (how CBModels are usually declared)
+    get a manager too.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None and cls._meta.abstract:
+            manager = copy.copy(self.manager)
+            manager.model = cls
+            return manager
+        return super(CBManagerDescriptor, self).__get__(instance, cls)
@@ -1,3 +1,731 @@
-from django.test import TestCase
+import datetime
+import json
+import unittest
+from decimal import Decimal
 
-# Create your tests here.
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import couchbase
+import couchbase.subdocument as SD
+from couchbase.exceptions import CouchbaseError
+from django.core.management import call_command
+from django.db import models
+from django.forms.models import model_to_dict
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from djangotoolbox.fields import DictField, EmbeddedModelField, ListField
+from six import StringIO
+from tastypie.serializers import Serializer
+
+from django_couchbase import benchmark, denormalize, fake, identity, instrumentation
+from django_couchbase.connection import BucketPool, connections
+from django_couchbase.denormalize import update_statement
+from django_couchbase.fake import FakeBucket
+from django_couchbase.fields import ModelReferenceField, PartialReferenceField
+from django_couchbase.indexes import CBIndex, create_statement, key_path, model_indexes, plan
+from django_couchbase.lazy import LazyEmbeddedList
+from django_couchbase.local_cache import MISSING
+from django_couchbase.management.commands import cb_indexes
+from django_couchbase.memcached import CouchbaseCache
+from django_couchbase.models import DOC_TYPE_FIELD_NAME, CBConflictError, CBModel, CBNestedModel
+from django_couchbase.query import CBManager, CBQuerySet
+from django_couchbase.transcoder import CODEC_SHIFT, FLAG_ZLIB, CacheTranscoder
+from django_couchbase.transfer import export_pages, import_chunks, page_statement
+
+class Publisher(CBModel):
+    class Meta:
+        abstract = True
+
+    doc_type = 'publisher'
+    id_prefix = 'pub'
+    bucket = 'TEST_BUCKET'
+
+    name = models.CharField(max_length=45, null=True, blank=True)
+
+
+class Author(CBModel):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    doc_type = 'author'
+    id_prefix = 'au'
+    bucket = 'TEST_BUCKET'
+
+    name = models.CharField(max_length=45, null=True, blank=True)
+
+
+class Book(CBModel):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    doc_type = 'book'
+    id_prefix = 'bk'
+    bucket = 'TEST_BUCKET'
+
+    name = models.CharField(max_length=45, null=True, blank=True, db_index=True)
+    pages = models.IntegerField(null=True)
+    author = ModelReferenceField(Author, max_length=45, null=True)
+    tags = ListField(models.CharField(max_length=20))
+
+    indexes = [CBIndex(['name', 'pages'])]
+
+
+class Chapter(CBNestedModel):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    id_prefix = 'ch'
+
+    title = models.CharField(max_length=45, null=True, blank=True)
+    words = models.IntegerField(null=True)
+
+
+class Edition(CBModel):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    doc_type = 'edition'
+    id_prefix = 'ed'
+    bucket = 'TEST_BUCKET'
+
+    title = models.CharField(max_length=45, null=True, blank=True)
+    price = models.DecimalField(max_digits=8, decimal_places=2, null=True)
+    published = models.DateTimeField(null=True)
+    in_print = models.BooleanField(default=True)
+    extra = DictField()
+    preface = EmbeddedModelField(Chapter, null=True)
+    chapters = ListField(EmbeddedModelField(Chapter))
+    authors = ListField(ModelReferenceField(Author, max_length=45))
+    tags = ListField(models.CharField(max_length=20))
+
+
+class Anthology(CBModel):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    doc_type = 'anthology'
+    id_prefix = 'an'
+    bucket = 'TEST_BUCKET'
+    lazy_embedded_lists = True
+
+    title = models.CharField(max_length=45, null=True, blank=True)
+    chapters = ListField(EmbeddedModelField(Chapter))
+
+
+class Quoted(CBModel):
+    class Meta:
+        abstract = True
+
+    bucket = 'TEST_BUCKET'
+
+    author = PartialReferenceField(Author, links={'author_name': 'name'}, max_length=45, null=True)
+
+
+class Review(Quoted):
+    class Meta:
+        app_label = 'django_couchbase'
+
+    doc_type = 'review'
+    id_prefix = 'rv'
+
+    text = models.CharField(max_length=200, null=True, blank=True)
+
+
+def tastypie_to_dict(obj):
+    """
+    CBModel.to_dict as it was before it was encoded natively: a JSON round
+    trip of model_to_dict through tastypie's serializer.
+    """
+    serializer = Serializer()
+    d = serializer.from_json(serializer.to_json(model_to_dict(obj)))
+    d[DOC_TYPE_FIELD_NAME] = obj.get_doc_type()
+    d['id'] = obj.get_id()
+    for name, encode in obj._field_encoders:
+        encode(obj, name, d)
+    return d
+
+
+# more fields than one sub-document operation takes
+SURVEY_FIELDS = ['q%02d' % i for i in range(20)]
+
+Survey = type(str('Survey'), (CBModel,), dict(
+    [(name, models.IntegerField(null=True)) for name in SURVEY_FIELDS],
+    Meta=type(str('Meta'), (), {'app_label': 'django_couchbase'}),
+    __module__=__name__, doc_type='survey', id_prefix='sv', bucket='TEST_BUCKET'))
+
+
+@override_settings(CB_BUCKETS={'TEST_BUCKET': 'fake://test'})
+class FakeBucketTestCase(SimpleTestCase):
+
+    def setUp(self):
+        connections.reset()
+        fake.reset()
+
+    def tearDown(self):
+        fake.reset()
+        connections.reset()
+
+
+class BucketPoolTests(SimpleTestCase):
+
+    def test_unhealthy_bucket_is_reopened(self):
+        pool = BucketPool('fake://test', health_check_interval=0)
+        first = pool.get()
+        self.assertIs(pool.get(), first)
+        first.get = mock.Mock(side_effect=CouchbaseError({'message': 'timed out'}))
+        second = pool.get()
+        self.assertIsNot(second, first)
+        self.assertIs(pool.get(), second)
+
+    def test_check_runs_outside_the_lock(self):
+        pool = BucketPool('fake://test', health_check_interval=0)
+        bucket = pool.get()
+        held = []
+
+        def probe(key, **kwargs):
+            held.append(pool._lock.locked())
+            # a concurrent caller meanwhile gets the bucket without a check
+            self.assertIs(pool.get(), bucket)
+
+        pool.health_check_interval = 60
+        pool._checked[0] -= 60
+        bucket.get = mock.Mock(side_effect=probe)
+        self.assertIs(pool.get(), bucket)
+        self.assertEqual(held, [False])
+
+    def test_checks_are_spaced(self):
+        pool = BucketPool('fake://test', health_check_interval=60)
+        bucket = pool.get()
+        bucket.get = mock.Mock()
+        for _ in range(3):
+            self.assertIs(pool.get(), bucket)
+        self.assertFalse(bucket.get.called)
+
+        pool = BucketPool('fake://test', health_check_interval=None)
+        bucket = pool.get()
+        bucket.get = mock.Mock(side_effect=CouchbaseError({'message': 'timed out'}))
+        self.assertIs(pool.get(), bucket)
+
+
+class QuerySetTests(FakeBucketTestCase):
+
+    def test_objects_on_concrete_model(self):
+        self.assertIsInstance(Book.objects, CBManager)
+        self.assertIsInstance(Book.objects.filter(name='x'), CBQuerySet)
+
+    def test_objects_on_abstract_model(self):
+        self.assertIsInstance(Publisher.objects.all(), CBQuerySet)
+        self.assertIs(Publisher.objects.all().model, Publisher)
+
+    def test_filter_statement(self):
+        statement, params = Book.objects.filter(pages__gte=100).exclude(name=None).order_by('-name')[:5].statement()
+        self.assertEqual(
+            statement,
+            'SELECT META(d).id AS `__id`, META(d).cas AS `__cas`, d AS `__doc` FROM `test` d '
+            'WHERE d.`doc_type` = "book" AND (d.`pages` >= $1) AND NOT (d.`name` IS NOT VALUED) '
+            'ORDER BY d.`name` DESC LIMIT 5')
+        self.assertEqual(params, [100])
+
+    def test_only_use_keys_statement(self):
+        statement, params = Book.objects.only('name').use_keys(['bk::1']).statement()
+        self.assertEqual(
+            statement,
+            'SELECT META(d).id AS `__id`, META(d).cas AS `__cas`, {"name": d.`name`} AS `__doc` '
+            'FROM `test` d USE KEYS $1 WHERE d.`doc_type` = "book"')
+        self.assertEqual(params, [['bk::1']])
+
+
+class ToDictTests(FakeBucketTestCase):
+
+    def test_matches_tastypie_round_trip(self):
+        author = Author(name='Herbert')
+        author.save()
+        published = timezone.make_aware(datetime.datetime(1965, 8, 1, 12, 30, 15, 250))
+        edition = Edition(
+            title='Dune', price=Decimal('9.90'), published=published,
+            extra={'z': Decimal('1.5'), 'a': [published, None], 'm': {'y': 1, 'b': 'x'}},
+            preface=Chapter(title='Preface', words=300),
+            chapters=[Chapter(title='One', words=5000), Chapter(title='Two')],
+            authors=[author, 'au::2'], tags=['sf', 'classic'])
+
+        expected = tastypie_to_dict(edition)
+        encoded = edition.to_dict()
+        # same values and the same key order at every level
+        self.assertEqual(encoded, expected)
+        self.assertEqual(json.dumps(encoded), json.dumps(expected))
+        self.assertEqual(encoded['price'], '9.90')
+        self.assertEqual(encoded['authors'], [author.id, 'au::2'])
+
+
+class LazyEmbeddedListTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(LazyEmbeddedListTests, self).setUp()
+        self.anthology = Anthology(title='Stories', chapters=[
+            Chapter(title='Chapter %d' % i, words=i) for i in range(10)])
+        self.anthology.save()
+
+    def test_items_hydrated_on_access(self):
+        loaded = Anthology.get(self.anthology.id)
+        self.assertIsInstance(loaded.chapters, LazyEmbeddedList)
+        self.assertEqual(loaded.chapters.hydrated_count, 0)
+        self.assertEqual(len(loaded.chapters), 10)
+        self.assertEqual(loaded.chapters[3].title, 'Chapter 3')
+        self.assertEqual(loaded.chapters.hydrated_count, 1)
+        self.assertFalse(loaded.is_dirty())
+        self.assertEqual(loaded.chapters.hydrated_count, 1)
+        self.assertEqual(loaded.to_dict()['chapters'], self.anthology.to_dict()['chapters'])
+
+    def test_comparisons_and_none_items(self):
+        loaded = Anthology.get(self.anthology.id)
+        self.assertFalse(loaded.chapters == None)
+        self.assertTrue(loaded.chapters != None)
+        loaded.chapters[2] = None
+        self.assertIsNone(loaded.chapters[2])
+        self.assertIsNone(loaded.chapters.to_dicts()[2])
+        self.assertEqual(loaded.chapters.hydrated_count, 1)
+
+
+class DirtyTrackingTests(FakeBucketTestCase):
+
+    def test_plain_list_round_trip(self):
+        book = Book(name='Dune', tags=['sf', 'classic'])
+        book.save()
+        loaded = Book.get(book.id)
+        self.assertEqual(loaded.tags, ['sf', 'classic'])
+        self.assertFalse(loaded.is_dirty())
+        loaded.tags.append('desert')
+        self.assertTrue(loaded.is_dirty())
+
+    def test_loaded_containers_are_not_shared(self):
+        edition = Edition(extra={'print': {'run': 1}}, preface=Chapter(title='Preface'))
+        edition.save()
+        loaded = Edition.get(edition.id)
+        loaded.extra['print']['run'] = 2
+        self.assertTrue(loaded.is_dirty())
+
+        book = Book(name='Dune', tags=['sf'])
+        book.save()
+        with identity.identity_map():
+            first = Book.get(book.id)
+            second = Book()
+            second.load(book.id)
+            self.assertIsNot(first.tags, second.tags)
+            first.tags.append('classic')
+            first.save()
+            self.assertEqual(second.tags, ['sf'])
+            self.assertFalse(second.is_dirty())
+
+    def test_is_dirty_does_not_save_references(self):
+        author = Author(name='Herbert')
+        author.save()
+        book = Book(name='Dune', author=author)
+        book.save()
+
+        loaded = Book.get(book.id)
+        loaded.author = author
+        author.name = 'Frank Herbert'
+        self.assertFalse(loaded.is_dirty())
+        self.assertEqual(Author.get(author.id).name, 'Herbert')
+
+        new_author = Author(name='Anderson')
+        loaded.author = new_author
+        self.assertTrue(loaded.is_dirty())
+        self.assertTrue(new_author.is_new())
+
+
+class BulkSaveTests(FakeBucketTestCase):
+
+    def test_stale_document_is_a_conflict(self):
+        dune, emma = Book(name='Dune'), Book(name='Emma')
+        Book.bulk_save([dune, emma])
+        other = Book.get(dune.id)
+        other.name = 'Children of Dune'
+        other.save()
+
+        dune.pages, emma.pages = 412, 474
+        ubik = Book(name='Ubik')
+        results = Book.bulk_save([dune, emma, ubik])
+        self.assertEqual(results, {dune.id: False, emma.id: True, ubik.id: True})
+        self.assertEqual(Book.db.get(dune.id).value['name'], 'Children of Dune')
+        self.assertEqual(Book.db.get(emma.id).value['pages'], 474)
+        self.assertTrue(dune.is_dirty())
+        self.assertFalse(emma.is_dirty())
+
+
+class FakeN1QLTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(FakeN1QLTests, self).setUp()
+        self.books = []
+        for name, pages, tags in (('Dune', 412, ['sf']), ('Emma', 474, []), ('Ubik', 202, ['sf']),
+                                  ('Dracula', None, ['horror'])):
+            book = Book(name=name, pages=pages, tags=tags)
+            book.save()
+            self.books.append(book)
+        Author(name='Dune').save()
+
+    def test_filter_order_limit(self):
+        names = [book.name for book in Book.objects.filter(pages__gte=300).order_by('-name')]
+        self.assertEqual(names, ['Emma', 'Dune'])
+        names = Book.objects.exclude(pages=None).order_by('pages')[1:3].values_list('name', flat=True)
+        self.assertEqual(list(names), ['Dune', 'Emma'])
+        self.assertEqual(Book.objects.filter(name__startswith='D').count(), 2)
+        self.assertEqual(Book.objects.filter(name__icontains='U').count(), 3)
+        self.assertEqual(Book.objects.filter(name__in=['Ubik', 'Emma'], pages__lt=300).get().name, 'Ubik')
+
+    def test_use_keys_and_only(self):
+        first, second = self.books[:2]
+        books = list(Book.objects.only('name').use_keys([second.id, first.id, 'bk::missing']))
+        self.assertEqual([(book.id, book.name, book.pages) for book in books],
+                         [(second.id, 'Emma', None), (first.id, 'Dune', None)])
+        self.assertEqual(books[0].rev, Book.db.get(second.id).cas)
+
+    def test_denormalize_update(self):
+        statement, params = update_statement(Book, 'name', {'pages': 1})
+        rows = Book.db.n1ql_query(statement, *(params + ['Ubik']))
+        self.assertEqual(rows, [])
+        self.assertEqual([book.pages for book in Book.objects.filter(name='Ubik')], [1])
+        self.assertEqual(Book.get(self.books[0].id).pages, 412)
+
+    def test_export_pages(self):
+        pages = list(export_pages(Book, page_size=3))
+        self.assertEqual([len(page) for page in pages], [3, 1])
+        ids = [id for page in pages for id, doc in page]
+        self.assertEqual(ids, sorted(book.id for book in self.books))
+
+    def test_unsupported_statement(self):
+        with self.assertRaises(NotImplementedError):
+            FakeBucket('test').n1ql_query('SELECT RAW name FROM system:indexes')
+
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_scenarios_run(self):
+        results = benchmark.run(number=2, repeat=1)
+        self.assertEqual(list(results), list(benchmark.SCENARIOS))
+        self.assertTrue(all(us > 0 for us in results.values()))
+
+
+class PartialTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(PartialTests, self).setUp()
+        self.survey = Survey(**dict((name, 0) for name in SURVEY_FIELDS))
+        self.survey.save()
+
+    def test_save_more_fields_than_one_mutation_takes(self):
+        partial = Survey.load_fields(self.survey.id, SURVEY_FIELDS)
+        for i, name in enumerate(SURVEY_FIELDS):
+            setattr(partial, name, i)
+        partial.save(allow_partial=True)
+        stored = Survey.db.get(self.survey.id)
+        self.assertEqual([stored.value[name] for name in SURVEY_FIELDS], list(range(20)))
+        self.assertEqual(partial.rev, stored.cas)
+
+    def test_load_retries_when_changed_between_lookups(self):
+        lookup_in = FakeBucket.lookup_in
+        calls = []
+
+        def changing_lookup_in(bucket, key, *specs, **kwargs):
+            rv = lookup_in(bucket, key, *specs, **kwargs)
+            calls.append(key)
+            if len(calls) == 1:
+                doc = bucket.get(key).value
+                doc['q19'] = 19
+                bucket.set(key, doc)
+            return rv
+
+        with mock.patch.object(FakeBucket, 'lookup_in', changing_lookup_in):
+            partial = Survey.load_fields(self.survey.id, SURVEY_FIELDS)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(partial.q19, 19)
+        self.assertEqual(partial.rev, Survey.db.get(self.survey.id).cas)
+
+    def test_load_gives_up_when_always_changing(self):
+        lookup_in = FakeBucket.lookup_in
+
+        def changing_lookup_in(bucket, key, *specs, **kwargs):
+            rv = lookup_in(bucket, key, *specs, **kwargs)
+            bucket.set(key, bucket.get(key).value)
+            return rv
+
+        with mock.patch.object(FakeBucket, 'lookup_in', changing_lookup_in):
+            with self.assertRaises(CBConflictError):
+                Survey.load_fields(self.survey.id, SURVEY_FIELDS)
+
+
+class InstrumentationTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(InstrumentationTests, self).setUp()
+        Book(name='Dune').save()
+        Book(name='Emma').save()
+        self.events = []
+        instrumentation.operation_finished.connect(self.record)
+
+    def tearDown(self):
+        instrumentation.operation_finished.disconnect(self.record)
+        super(InstrumentationTests, self).tearDown()
+
+    def record(self, sender, op, outcome, keys, **kwargs):
+        if op == 'n1ql_query':
+            self.events.append((outcome, keys))
+        elif op == 'set_multi':
+            self.events.append((outcome, keys, kwargs['bytes'] > 0))
+
+    @override_settings(CB_INSTRUMENTATION=True)
+    def test_query_outcomes(self):
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertIsNotNone(Book.objects.first())
+        self.assertTrue(Book.objects.exists())
+        with self.assertRaises(NotImplementedError):
+            list(Book.db.n1ql_query('SELECT RAW name FROM system:indexes'))
+        self.assertEqual(self.events, [('ok', 1), ('ok', 1), ('ok', 1), ('error', 0)])
+
+    @override_settings(CB_INSTRUMENTATION=True, CB_INSTRUMENTATION_BYTES=True)
+    def test_bulk_save_bytes(self):
+        books = list(Book.objects.all())
+        for book in books:
+            book.pages = 100
+        Book.bulk_save(books)
+        self.assertEqual(self.events, [('ok', 2), ('ok', 2, True)])
+
+
+class StoredReferencesListTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(StoredReferencesListTests, self).setUp()
+        self.book = Book(name='Dune', tags=['sf', 'classic', 'desert'])
+        self.book.save()
+
+    def test_append_and_delete(self):
+        self.book.append_to_stored_references_list('tags', 'spice')
+        self.book.delete_from_stored_references_list('tags', 'classic')
+        self.assertEqual(self.book.tags, ['sf', 'desert', 'spice'])
+        self.assertEqual(Book.db.get(self.book.id).value['tags'], ['sf', 'desert', 'spice'])
+        self.assertFalse(self.book.is_dirty())
+        self.book.name = 'Dune Messiah'
+        self.book.save()
+        self.assertEqual(Book.get(self.book.id).tags, ['sf', 'desert', 'spice'])
+
+    def test_delete_with_sdk_lookup_results(self):
+        # the SDK's SubdocResult.get returns (error, value), not the value
+        rv = Book.db.lookup_in(self.book.id, SD.get('tags'), SD.get('missing'))
+        self.assertEqual(rv.get('tags'), (0, ['sf', 'classic', 'desert']))
+        self.assertEqual(rv.get('missing')[1], None)
+        self.assertNotEqual(rv.get('missing')[0], 0)
+
+        self.book.delete_from_stored_references_list('tags', 'classic')
+        self.assertEqual(Book.db.get(self.book.id).value['tags'], ['sf', 'desert'])
+        self.assertEqual(self.book.tags, ['sf', 'desert'])
+
+    def test_concurrent_write_is_a_conflict(self):
+        other = Book.get(self.book.id)
+        other.name = 'Children of Dune'
+        other.save()
+        with self.assertRaises(CBConflictError):
+            self.book.append_to_stored_references_list('tags', 'spice')
+        with self.assertRaises(CBConflictError):
+            self.book.delete_from_stored_references_list('tags', 'classic')
+        stored = Book.db.get(self.book.id).value
+        self.assertEqual(stored['tags'], ['sf', 'classic', 'desert'])
+        self.assertEqual(stored['name'], 'Children of Dune')
+
+
+class LoadRelatedTests(FakeBucketTestCase):
+
+    def test_load_related(self):
+        author = Author(name='Herbert')
+        author.save()
+        book = Book(name='Dune', author=author.id)
+        self.assertEqual(book.load_related('author', Author).name, 'Herbert')
+
+    def test_unset_reference_gives_empty_object(self):
+        for unset in (None, ''):
+            related = Book(name='Dune', author=unset).load_related('author', Author)
+            self.assertIsInstance(related, Author)
+            self.assertTrue(related.is_new())
+
+
+@override_settings(CB_DENORMALIZE_SYNC=True)
+class DenormalizeTests(FakeBucketTestCase):
+
+    def setUp(self):
+        super(DenormalizeTests, self).setUp()
+        self.author = Author(name='Herbert')
+        self.author.save()
+        self.review = Review(author=self.author, text='Great')
+        self.review.save()
+
+    def test_only_concrete_models_are_dependents(self):
+        self.assertEqual([(model, name) for model, name, links in denormalize.dependents(Author)],
+                         [(Review, 'author')])
+
+    def test_changed_name_is_copied(self):
+        author = Author.get(self.author.id)
+        author.name = 'Frank Herbert'
+        author.save()
+        self.assertEqual(Review.db.get(self.review.id).value['author_name'], 'Frank Herbert')
+
+    def test_saved_over_without_loading(self):
+        author = Author(name='Frank Herbert')
+        author.id = self.author.id
+        author.save()
+        self.assertEqual(Review.db.get(self.review.id).value['author_name'], 'Frank Herbert')
+
+
+class IdentityMapTests(FakeBucketTestCase):
+
+    def test_same_instance_within_map(self):
+        book = Book(name='Dune')
+        book.save()
+        with identity.identity_map():
+            self.assertIs(Book.get(book.id), Book.get(book.id))
+        self.assertIsNot(Book.get(book.id), Book.get(book.id))
+
+    @unittest.skipIf(contextvars is None, 'contextvars needs Python 3.7')
+    def test_map_is_scoped_to_the_context(self):
+        # a coroutine started elsewhere on the same thread does not see it
+        other = contextvars.copy_context()
+        with identity.identity_map() as active:
+            self.assertIs(identity.current(), active)
+            self.assertIsNone(other.run(identity.current))
+        self.assertIsNone(identity.current())
+
+
+class IndexTests(FakeBucketTestCase):
+
+    def test_model_indexes(self):
+        self.assertEqual([(i.name, i.fields) for i in model_indexes(Book)], [
+            ('book_doc_type_idx', ['doc_type']),
+            ('book_id_idx', ['META().id']),
+            ('book_name_idx', ['name']),
+            ('book_name_pages_idx', ['name', 'pages']),
+        ])
+
+    def test_create_statement(self):
+        self.assertEqual(
+            create_statement(Book, model_indexes(Book)[2]),
+            'CREATE INDEX `book_name_idx` ON `test`(`name`) WHERE `doc_type` = "book" '
+            'WITH {"defer_build": true}')
+
+    def test_query_predicate_matches_partial_index(self):
+        # the planner only uses a partial index if the query repeats its
+        # condition literally
+        statement, params = Book.objects.filter(name='x').statement()
+        index_condition = create_statement(Book, model_indexes(Book)[2]).split(' WHERE ')[1].split(' WITH ')[0]
+        self.assertIn(index_condition.replace('`doc_type`', 'd.`doc_type`'), statement)
+        self.assertNotIn('book', params)
+
+    def test_id_index(self):
+        self.assertEqual(
+            create_statement(Book, model_indexes(Book)[1]),
+            'CREATE INDEX `book_id_idx` ON `test`(META().id) WHERE `doc_type` = "book" '
+            'WITH {"defer_build": true}')
+
+    def test_update_statement(self):
+        statement, params = update_statement(Book, 'author', {'author_name': 'Tolkien'})
+        self.assertEqual(
+            statement,
+            'UPDATE `test` AS d SET d.`author_name` = $1 WHERE d.`doc_type` = "book" AND d.`author` = $2')
+        self.assertEqual(params, ['Tolkien'])
+
+    def test_page_statement(self):
+        self.assertEqual(
+            page_statement(Book, 100),
+            'SELECT META(d).id AS `__id`, d AS `__doc` FROM `test` d WHERE d.`doc_type` = "book" '
+            'AND META(d).id > $1 ORDER BY META(d).id LIMIT 100')
+
+    def test_plan(self):
+        existing = {'test': {
+            'book_doc_type_idx': {'index_key': ['`doc_type`'], 'state': 'online'},
+            'book_id_idx': {'index_key': ['(meta().`id`)'], 'state': 'deferred'},
+            'book_name_idx': {'index_key': ['`title`'], 'state': 'deferred'},
+        }}
+        creates, drops, builds = plan([Book], existing)
+        self.assertEqual(drops, {'test': ['book_name_idx']})
+        self.assertEqual([name for name, statement in creates['test']],
+                         ['book_name_idx', 'book_name_pages_idx'])
+        self.assertEqual(builds, {'test': ['book_id_idx', 'book_name_idx', 'book_name_pages_idx']})
+
+    def test_command_builds_deferred_indexes(self):
+        rows = [{'name': index.name, 'index_key': [key_path(f) for f in index.fields], 'state': 'online'}
+                for index in model_indexes(Book)]
+        rows[1]['state'] = 'deferred'
+        out = StringIO()
+        with mock.patch.object(cb_indexes, 'get_models', return_value=[Book]), \
+                mock.patch.object(cb_indexes, 'n1ql_executor', return_value=lambda statement, params: rows):
+            call_command('cb_indexes', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['BUILD INDEX ON `test`(`book_id_idx`)'])
+
+
+class TransferTests(FakeBucketTestCase):
+
+    def test_import_opens_one_bucket_per_worker(self):
+        chunks = [(i + 1, {'bk::%d' % i: {'doc_type': 'book', 'name': str(i)}}) for i in range(6)]
+        chunks.append((7, {'au::1': {'doc_type': 'author'}}))
+        with mock.patch.object(connections, 'open', wraps=connections.open) as open_bucket:
+            results = list(import_chunks(Book, chunks, concurrency=3))
+        self.assertEqual(open_bucket.call_count, 3)
+        self.assertEqual(results, [(i, 1, 0) for i in range(1, 7)] + [(7, 0, 1)])
+        self.assertEqual(Book.db.get('bk::5').value['name'], '5')
+
+
+class CacheTests(SimpleTestCase):
+
+    def setUp(self):
+        fake.reset()
+
+    def cache(self, location, **options):
+        return CouchbaseCache([location], {'OPTIONS': options})
+
+    def test_local_cache_invalidated_across_instances(self):
+        # Django creates one backend instance per thread
+        first = self.cache('fake://shared-local', local_cache={'timeout': 60})
+        second = self.cache('fake://shared-local', local_cache={'timeout': 60})
+        first.set('key', 1)
+        self.assertEqual(second.get('key'), 1)
+        first.set('key', 2)
+        self.assertEqual(second.get('key'), 2)
+
+    def test_stampede_stats_shared_across_instances(self):
+        first = self.cache('fake://shared-stats')
+        second = self.cache('fake://shared-stats')
+        self.assertEqual(first.get_or_set('key', 1), 1)
+        self.assertEqual(second.get_or_set('key', 2), 1)
+        self.assertEqual(first.stampede_stats(), {'recomputes': 1, 'hits': 1})
+        self.assertEqual(second.stampede_stats(), first.stampede_stats())
+        self.assertEqual(self.cache('fake://other-stats').stampede_stats(), {})
+
+    def test_default_options_read_compressed_values(self):
+        cache = self.cache('127.0.0.1:8091')
+        cache._lib = mock.Mock()
+        self.assertIsNotNone(cache._cache)
+        transcoder = cache._lib.connect.call_args[1]['transcoder']
+        self.assertIsInstance(transcoder, CacheTranscoder)
+
+        value = {'text': 'x' * 1000}
+        writer = CacheTranscoder(min_size=100, compression='zlib')
+        encoded, flags = writer.encode_value(value, couchbase.FMT_PICKLE)
+        self.assertTrue(flags & FLAG_ZLIB)
+        self.assertEqual(transcoder.decode_value(encoded, flags), value)
+
+        writer = CacheTranscoder(serializer='json', min_size=100, compression='zlib')
+        self.assertEqual(transcoder.decode_value(*writer.encode_value(value, couchbase.FMT_PICKLE)), value)
+
+    def test_unknown_codec_is_a_miss(self):
+        transcoder = CacheTranscoder()
+        self.assertIs(transcoder.decode_value(b'?', couchbase.FMT_BYTES | (0xEE << CODEC_SHIFT)), MISSING)
+        cache = self.cache('127.0.0.1:8091')
+        cache._client = mock.Mock()
+        cache._client.get.return_value = mock.Mock(value=MISSING)
+        self.assertEqual(cache.get('key', 'default'), 'default')
@@ -0,0 +1,143 @@
+"""
+Transcoders for CouchbaseCache.
+
+CompressingTranscoder compresses encoded values of at least ``min_size``
+bytes with zstd, lz4 or zlib and marks them in the item flags, so decoding
+is automatic and values written without compression stay readable.
+
+CacheTranscoder additionally serializes values with a codec from
+``cache_codecs`` and stores the codec id in the flags. Items without a codec
+id are decoded with the SDK formats. Items with a codec or compression this
+process cannot decode are returned as ``local_cache.MISSING``, which
+CouchbaseCache treats as a miss.
+"""
+from collections import OrderedDict
+
+import couchbase
+from couchbase.transcoder import Transcoder
+
+from django_couchbase.cache_codecs import get_codec, get_codec_by_id
+from django_couchbase.local_cache import MISSING
+
+# bits 4-6 of the item flags are unused by the SDK formats
+FLAG_ZLIB = 0x10
+FLAG_LZ4 = 0x20
+FLAG_ZSTD = 0x40
+COMPRESSION_MASK = FLAG_ZLIB | FLAG_LZ4 | FLAG_ZSTD
+
+# so are bits 8-15, they hold the codec id
+CODEC_SHIFT = 8
+CODEC_MASK = 0xFF << CODEC_SHIFT
+
+DEFAULT_MIN_SIZE = 16 * 1024
+
+
+def _zstd():
+    import zstandard
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+def _zlib():
+    import zlib
+    return zlib.compress, zlib.decompress
+
+
+# in order of preference for 'auto'
+COMPRESSIONS = OrderedDict([
+    ('zstd', (FLAG_ZSTD, _zstd)),
+    ('lz4', (FLAG_LZ4, _lz4)),
+    ('zlib', (FLAG_ZLIB, _zlib)),
+])
+
+
+def get_compression(name='auto'):
+    """
+    Returns (flag, compress, decompress) for ``name``, 'auto' picks the
+    first importable library.
+    """
+    if name == 'auto':
+        for candidate in COMPRESSIONS:
+            try:
+                return get_compression(candidate)
+            except ImportError:
+                continue
+    if name not in COMPRESSIONS:
+        raise ValueError("unknown compression '%s'" % name)
+    flag, load = COMPRESSIONS[name]
+    compress, decompress = load()
+    return flag, compress, decompress
+
+
+class CompressingTranscoder(Transcoder):
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, compression='auto'):
+        super(CompressingTranscoder, self).__init__()
+        self.min_size = min_size
+        self._flag, self._compress = 0, None
+        if compression:
+            self._flag, self._compress, _ = get_compression(compression)
+        self._decompressors = {}
+
+    def _decompressor(self, flag):
+        decompress = self._decompressors.get(flag)
+        if decompress is None:
+            for name, (candidate, load) in COMPRESSIONS.items():
+                if candidate == flag:
+                    decompress = self._decompressors[flag] = load()[1]
+                    break
+            else:
+                raise ValueError('unknown compression flag 0x%x' % flag)
+        return decompress
+
+    def compress(self, value, flags):
+        if self._compress is not None and len(value) >= self.min_size:
+            compressed = self._compress(value)
+            if len(compressed) < len(value):
+                return compressed, flags | self._flag
+        return value, flags
+
+    def decompress(self, value, flags):
+        flag = flags & COMPRESSION_MASK
+        if flag:
+            value = self._decompressor(flag)(value)
+        return value, flags & ~COMPRESSION_MASK
+
+    def encode_value(self, value, format):
+        value, flags = super(CompressingTranscoder, self).encode_value(value, format)
+        return self.compress(value, flags)
+
+    def decode_value(self, value, flags):
+        try:
+            value, flags = self.decompress(value, flags)
+        except (ValueError, ImportError):
+            return MISSING
+        return super(CompressingTranscoder, self).decode_value(value, flags)
+
+
+class CacheTranscoder(CompressingTranscoder):
+
+    def __init__(self, serializer=None, min_size=DEFAULT_MIN_SIZE, compression=None):
+        super(CacheTranscoder, self).__init__(min_size=min_size, compression=compression)
+        self.codec = get_codec(serializer) if serializer else None
+
+    def encode_value(self, value, format):
+        if self.codec is None:
+            return super(CacheTranscoder, self).encode_value(value, format)
+        flags = couchbase.FMT_BYTES | (self.codec.codec_id << CODEC_SHIFT)
+        return self.compress(self.codec.dumps(value), flags)
+
+    def decode_value(self, value, flags):
+        codec_id = (flags & CODEC_MASK) >> CODEC_SHIFT
+        if not codec_id:
+            return super(CacheTranscoder, self).decode_value(value, flags)
+        try:
+            codec = get_codec_by_id(codec_id, self.codec)
+            value, flags = self.decompress(value, flags)
+        except (ValueError, ImportError):
+            return MISSING
+        return codec.loads(value)
@@ -0,0 +1,156 @@
+"""
+Streaming export and import of the documents of one doc type, used by the
+``cb_export`` and ``cb_import`` commands.
+
+Documents are written as NDJSON, one ``{"id": ..., "doc": {...}}`` object per
+line, gzip-compressed when the file name ends with ``.gz``. Exports page
+through the documents ordered by id (keyset paging, so every page is a
+range scan of the ``<doc_type>_id_idx`` index created by ``cb_indexes``);
+imports write chunks with ``set_multi`` on a few threads, each with a bucket
+of its own. Both keep a checkpoint file to resume an interrupted run.
+"""
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from six import text_type
+
+from django_couchbase.connection import bucket_name, connections
+from django_couchbase.query import ALIAS, doc_type_condition, n1ql_executor, quote
+
+EXPORT_PAGE_SIZE = 1000
+IMPORT_CHUNK_SIZE = 500
+IMPORT_CONCURRENCY = 4
+
+_worker = threading.local()
+
+
+def open_stream(path, mode):
+    """
+    Opens ``path`` ('-' is stdin/stdout) as text, through gzip for '.gz'.
+    """
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode.replace('t', '') + 'b'), encoding='utf-8')
+    return io.open(path, mode.replace('t', ''), encoding='utf-8')
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def write_checkpoint(path, state):
+    if not path:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def page_statement(model, page_size):
+    """
+    The keyset query returning the next ``page_size`` documents after the id
+    given as parameter.
+    """
+    meta_id = 'META(%s).id' % ALIAS
+    return ('SELECT %s AS `__id`, %s AS `__doc` FROM %s %s WHERE %s AND %s > $1 '
+            'ORDER BY %s LIMIT %d' % (meta_id, ALIAS, quote(bucket_name(model.bucket)), ALIAS,
+                                      doc_type_condition(model), meta_id, meta_id, page_size))
+
+
+def export_pages(model, after='', page_size=EXPORT_PAGE_SIZE, executor=None):
+    """
+    Yields lists of (id, document) of ``model``, ordered by id, starting
+    after the id ``after``.
+    """
+    execute = executor or n1ql_executor(model)
+    statement = page_statement(model, page_size)
+    while True:
+        page = [(row['__id'], row['__doc']) for row in execute(statement, [after])]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1][0]
+
+
+def dump_line(id, doc):
+    return text_type(json.dumps({'id': id, 'doc': doc}, separators=(',', ':'), sort_keys=True)) + '\n'
+
+
+def read_chunks(stream, chunk_size=IMPORT_CHUNK_SIZE, skip=0):
+    """
+    Yields (number of lines read so far, {id: document}) per chunk, after
+    skipping ``skip`` lines.
+    """
+    chunk = {}
+    line_no = 0
+    for line_no, line in enumerate(stream, 1):
+        if line_no <= skip or not line.strip():
+            continue
+        item = json.loads(line)
+        chunk[item['id']] = item['doc']
+        if len(chunk) >= chunk_size:
+            yield line_no, chunk
+            chunk = {}
+    if chunk:
+        yield line_no, chunk
+
+
+def write_chunk(model, docs, skip_existing=False, db=None):
+    """
+    Stores ``docs`` with one multi operation on ``db`` (default the model's
+    shared bucket) and returns (written, failed). Documents of another doc
+    type count as failed.
+    """
+    from django_couchbase.models import DOC_TYPE_FIELD_NAME, _multi_results
+    doc_type = model().get_doc_type()
+    valid = dict((id, doc) for id, doc in docs.items() if doc.get(DOC_TYPE_FIELD_NAME) == doc_type)
+    db = db or model.db
+    results = _multi_results(db.add_multi if skip_existing else db.set_multi, valid)
+    written = sum(1 for result in results.values() if result.success)
+    return written, len(docs) - written
+
+
+def _open_worker_bucket(alias):
+    _worker.db = connections.open(alias)
+
+
+def _write_worker_chunk(model, docs, skip_existing):
+    return write_chunk(model, docs, skip_existing, _worker.db)
+
+
+def import_chunks(model, chunks, concurrency=IMPORT_CONCURRENCY, skip_existing=False):
+    """
+    Writes the (line number, docs) ``chunks`` with up to ``concurrency``
+    chunks in flight and yields (line number, written, failed) in input
+    order, so the line number is a safe resume point.
+
+    Every worker thread opens its own bucket: the pooled ones are shared
+    with LOCKMODE_WAIT, which would serialize the workers.
+    """
+    pool = ThreadPool(concurrency, _open_worker_bucket, (model.bucket,))
+    pending = deque()
+    try:
+        for line_no, docs in chunks:
+            pending.append((line_no, pool.apply_async(_write_worker_chunk, (model, docs, skip_existing))))
+            if len(pending) >= concurrency:
+                line_no, result = pending.popleft()
+                yield (line_no,) + result.get()
+        while pending:
+            line_no, result = pending.popleft()
+            yield (line_no,) + result.get()
+    finally:
+        pool.close()
+        pool.join()